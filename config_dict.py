@@ -7,5 +7,55 @@ CONFIG = { 'length' : 20,
            #'max_mass' : length * height -- 200
            'allowable_stress' : 4.0e-5,
            'nelx'   : 20,
-           'nely'   : 10
+           'nely'   : 10,
+           # FEM linear solver: 'cg', 'pcg' (Jacobi preconditioned),
+           # 'sgscg' (symmetric Gauss-Seidel preconditioned), 'direct' (sparse LU),
+           # 'banded' (banded Cholesky), 'mgcg' (multigrid preconditioned,
+           # for fine meshes), 'woodbury' (low rank updates of a reference
+           # factorization, for many small moves around one design) or 'mfcg'
+           # (matrix free Jacobi preconditioned, for meshes too large to assemble)
+           # or 'mixed' (float32 banded Cholesky refined in float64, half the memory)
+           'solver' : 'cg',
+           # FEM load cases, the bridge stress is the worst of them: 'uniform',
+           # 'point' (midspan), 'lane' (outer half of the deck), 'self_weight'
+           'load_cases' : ['uniform'],
+           # the number of FEM solutions kept per bridge for repeated density
+           # fields (least recently used dropped first), 0 to disable the cache
+           'fem_cache_size' : 256,
+           # stop the FEM solve of a design as soon as the work of the load F.U
+           # (not sigma) is proven to exceed this and flag it infeasible, None
+           # to always solve to convergence
+           'compliance_limit' : None,
+           # FEM element densities: 'sample' (one point per element) or
+           # 'coverage' (exact fraction of the element outside the hole)
+           'density' : 'sample',
+           # the order of the free dofs the FEM solves in: None (the grid
+           # numbering), 'rcm' (reverse Cuthill-McKee) or 'nd' (nested
+           # dissection, cuts the fill of 'direct' on large meshes)
+           'ordering' : None,
+           # the circle packing radii solver: 'newton' (damped Newton steps in
+           # log radius), 'fixed_step' (the original +-delta_r sweeps) or 'local'
+           # (relaxes only the circles off by more than eps, for small moves of
+           # a few leading dancers)
+           'packing_solver' : 'newton',
+           # the budgets of the radii solve of every update, None for no limit:
+           # the most Newton steps and sweeps (circle relaxations of 'local'),
+           # the most seconds, and the sweeps
+           # without progress before the solve is given up as stagnated
+           'packing_max_iterations' : 10000,
+           'packing_time_budget' : 1.0,
+           'packing_patience' : 500,
+           # True to compute the gradient of sigma with respect to the radii of
+           # the leading dancers in every update, at the cost of an adjoint FEM
+           # solve; off, gsigma_rld is None
+           'sigma_gradient' : False,
+           # the FEM mesh: 'uniform' (the nely x nelx grid) or 'adaptive' (the
+           # grid refined 3 times near the hole boundary, sharper stresses at a
+           # fraction of the dofs of the fine grid; needs sigma_gradient False
+           # and a direct or preconditioned solver)
+           'mesh_type' : 'uniform',
+           # True to start the CG solvers of every update from the last solution
+           # with the last preconditioner: fewer iterations, but sigma then depends
+           # on the earlier designs of the episode within the CG tolerance
+           'warm_start' : False
          }
@@ -7,7 +7,8 @@ Provides:
     BHDEnv(bridge = instance of pepperoni.BridgeHoleDesign,
            length = float,
            height = float,
-           allowable_stress = float)
+           allowable_stress = float,
+           compliance_limit = float or None)
         BHDEnv an OpenAI Gym gym.Env object.
     
    observe_bridge_update(data, length, height, allowable_stress)
@@ -154,7 +155,8 @@ class BHDEnv(gym.Env):
                  bridge=None,
                  length=CONFIG['length'],
                  height=CONFIG['height'],
-                 allowable_stress=CONFIG['allowable_stress']):
+                 allowable_stress=CONFIG['allowable_stress'],
+                 compliance_limit=CONFIG['compliance_limit']):
 
         self.__version__ = "0.1.3"
 
@@ -162,6 +164,9 @@ class BHDEnv(gym.Env):
         self.length = length
         self.height = height
         self.allowable_stress = allowable_stress
+        # new bridges stop their FEM solve early on designs beyond this work of the load
+        # (see pepperoni.BridgeHoleDesign); their large stress then ends the episode
+        self.compliance_limit = compliance_limit
         self.max_mass = self.length * self.height
         # self.reset sets self.bridge, used later
         self.reset(bridge=bridge)
@@ -200,7 +205,9 @@ class BHDEnv(gym.Env):
             reward (float) : reward returned: observation['mass_ratio']
             done (boolean): whether the episode has ended, in which case further
                 step() calls will return undefined results.
-                True if observation['stress'] >= allowable_stress.
+                True if observation['stress'] >= allowable_stress, or if the circle
+                packing of the new rld was not solved within the budgets of the bridge
+                (see BridgeHoleDesign.update, 'packing_status').
             info (dict): Empty dict; to be used for debugging and logging info.         
         """
         new_rld = self.rld + action*lr
@@ -240,6 +247,13 @@ class BHDEnv(gym.Env):
             print("Stress ratio is", ob[-1],"\n\n")
             reward = 0
             done = True
+
+        if not data['packing_status']['converged']:
+            # the bridge gave up on the packing and stayed at the previous rld
+            print("Packing solve", data['packing_status']['status'], "\n\n")
+            self.rld = np.array(self.bridge.rld)
+            reward = 0
+            done = True
         # Useful info: rld for sure. mass, stress, and image can be retrieved from that.
     
         return ob, reward, done, info
@@ -249,7 +263,7 @@ class BHDEnv(gym.Env):
         Returns: observation (array): the initial observation of the space."""
         self.bridge = bridge
         if self.bridge is None:
-            self.bridge = BridgeHoleDesign()
+            self.bridge = BridgeHoleDesign(compliance_limit=self.compliance_limit)
 
         self.rld = np.array(self.bridge.rld)
         data = self.bridge.update(self.bridge.rld)
@@ -1,14 +1,27 @@
 """Circle-packing related utilities."""
 from math import sqrt, cos, sin, acos, ceil, atan2
 import random
+import heapq
+from time import time
 import numpy as np
 from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import splu
 import matplotlib.pyplot as plt
-from _FEM import _ccw, _membershiptest, _FEM
+from _FEM import _ccw, _membershiptest, _FEM, _FEM_batch, _SolverState, _FEMCache, \
+    _get_mesh, _rescale, E0
 from config_dict import CONFIG
 
 class BridgeHoleDesign:
-    def __init__(self):
+    def __init__(self, solver=CONFIG['solver'], load_cases=CONFIG['load_cases'],
+                 fem_cache_size=CONFIG['fem_cache_size'],
+                 compliance_limit=CONFIG['compliance_limit'], density=CONFIG['density'],
+                 ordering=CONFIG['ordering'], packing_solver=CONFIG['packing_solver'],
+                 packing_max_iterations=CONFIG['packing_max_iterations'],
+                 packing_time_budget=CONFIG['packing_time_budget'],
+                 packing_patience=CONFIG['packing_patience'],
+                 sigma_gradient=CONFIG['sigma_gradient'], mesh_type=CONFIG['mesh_type'],
+                 warm_start=CONFIG['warm_start']):
         self.l = CONFIG['length']  # the half length of the bridge
         self.h = CONFIG['height']  # the height of the bridge
         self.a_ell = 16.0  # the initial shape of the hole is an ellipse
@@ -18,43 +31,64 @@ class BridgeHoleDesign:
         self.delta_r = 0.001  # the changes in each iteration in the process of calculation
         self.nely = CONFIG['nely']  # the number of elements in y direction for FEM
         self.nelx = CONFIG['nelx']  # the number of elements in x direction for FEM
+        self.solver = solver  # the FEM linear solver backend, see _FEM._SOLVERS
+        # the rasterization, stiffness matrix and, with warm_start, the CG initial guess and
+        # preconditioner kept between updates (see _FEM._SolverState)
+        self._solver_state = _SolverState(warm_start=warm_start)
+        self.load_cases = list(load_cases)  # the FEM load cases, see _FEM._LOADS
+        # the FEM solutions of recent density fields and their hit/miss counters, None if disabled
+        self.fem_cache = _FEMCache(fem_cache_size) if fem_cache_size else None
+        # the largest work of the load F.U before the FEM solve gives up on a design, None for no limit
+        self.compliance_limit = compliance_limit
+        self.density = density  # how the hole is rasterized for FEM, 'sample' or 'coverage'
+        self.ordering = ordering  # the free dof order of the FEM solve, None, 'rcm' or 'nd'
+        self.packing_solver = packing_solver  # how the radii are solved, 'newton', 'fixed_step' or 'local'
+        # the budgets of the radii solve of update, None for no limit, see _calculate_radii
+        self.packing_max_iterations = packing_max_iterations
+        self.packing_time_budget = packing_time_budget
+        self.packing_patience = packing_patience
+        # True to compute gsigma_rld in every update (an adjoint FEM solve), else it is None
+        self.sigma_gradient = sigma_gradient
+        # the FEM mesh, 'uniform' or 'adaptive' (refined near the hole, no gradient)
+        if mesh_type == 'adaptive' and sigma_gradient:
+            raise ValueError("The adaptive mesh has no gradient, use sigma_gradient=False")
+        self.mesh_type = mesh_type
         # Values initialized below:
-        #self.ri = []  # List of float > 0, the radii of interior circles
-        #self.raccb = []  # List of float > 0, the radii of accompanying boundary circles
-        #self.rld = []  # List of float > 0, the radii of leading dancers
-        #self.r = []  # List of float > 0, the radii of all circles
-        #self.sigma = []  # float, the maximum stress in the bridge under the loads
+        #self.ri = []  # float array > 0, the radii of interior circles, a view of self.r
+        #self.raccb = []  # float array > 0, the radii of accompanying boundary circles, a view of self.r
+        #self.rld = []  # float array > 0, the radii of leading dancers, a view of self.r
+        #self.r = []  # float array > 0, the radii of all circles, self._packing.radius
+        #self.sigma = []  # float, the maximum stress in the bridge under the loads, worst load case
+        #self.sigma_cases = []  # float array, the stress of every load case
+        #self.von_mises_max = []  # float, the largest element von Mises stress (MPa), worst load case
+        #self.von_mises_pnorm = []  # float, the p-norm of the element von Mises stresses (MPa), worst load case
+        #self.von_mises_max_cases = []  # float array, the largest von Mises stress of every load case
         #self.area = []  # float, the area of the hole
         #self.mass = []  # float, the mass of the bridge, density is 1
-        #self.gmass_r = []  # list of float, the gradient of mass resprect to all radii
-        #self.gmass_rld = []  # list of float, the gradient of mass repsect ot leading dancers
+        #self.gmass_r = []  # float array, the gradient of mass resprect to all radii
+        #self.gmass_rld = []  # float array, the gradient of mass repsect ot leading dancers
+        #self.gsigma_rld = []  # list of float, the gradient of sigma respect to leading dancers, worst load case, None unless sigma_gradient
         #self.angles_ld = []  # list of float, the surround angles of leading dancers
         #self.angles_accb = []  # list of float, the surround angles of accompanying boundary dancers
         #self.angles_cb = []  # list of float, the surround angles of boundary circles
         #self.total_length_ld = []  # float, the total edge length of leading dancers
         #self.total_length_accb = []  # float, the total edge length of accompanying boundary dancers
         #self.total_length_cb = []  # float, the total edge length of boundary circles
-        #self.edges_ld = []  # list of float, the edge list of leading dancers
-        #self.edges_accb = []  # list of float, the edge list of accompanying boundary dancers
+        #self.edges_ld = []  # float array, the edge list of leading dancers
+        #self.edges_accb = []  # float array, the edge list of accompanying boundary dancers
         #self.edges_cb = []  # list of float, the edge list of boundary circles
-        #self.positions_ld = []  # nX2 array, the x and y coordinates of center of leading dancers
-        #self.positions_accb = []  # nX2 array, the x and y coordinates of center of accompanying boundary dancers
-        #self.positions_ci = []  # nX2 array, the x and y coordinates of center of interior circles
+        #self.positions_ld = []  # nX2 array, the x and y coordinates of center of leading dancers, a view of self._packing.xy
+        #self.positions_accb = []  # nX2 array, the x and y coordinates of center of accompanying boundary dancers, a view
+        #self.positions_ci = []  # nX2 array, the x and y coordinates of center of interior circles, a view
         #self.positions_cb = []  # nX2 array, the x and y coordinates of center of boundary circles
         #self.positions_all = []  # nX2 array, the x and y coordinates of center of all circles
         #self._tri = []  # Delaunay, a triangluation instance
-        #self._circles = []  # list of _CircleVertex, recording information of all circles
-        #self._halfedges = []  # list of _HalfEdge, the halfedges in the triangulation
-        #self._faces = []  # list of _Face, the faces in the triangulation
-        #self._LD = []  # list of CircleVertex, collection of leading dancers
-        #self._AccB = []  # list of CircleVertex, collection of accompanying boundary dancers
-        #self._ci = []  # list of CircleVertex, collection of interior circles
-        #self._AD = []  # list of CircleVertex, collection of accompanying dancers
-        #self._cb = []  # list of CircleVertex, collection of boundary circles
-        #self._anchor_x = []  # list of CircleVertex, the circles lying along x axis
-        #self._anchor_y = []  # list of CircleVertex, the circles lying along y axis
-        #self._cb_origin = []  # CircleVertex, the circle lying on origin of coordinate
+        #self._packing = []  # _Packing, the radii, centers and topology of all circles
         #self._edges = []  # nX5 arrary, the coordinates of leading dancers
+        #self._fem_info = []  # dict, the element fields of the last FEM analysis per load case, see _FEM
+        #self.packing_iterations = []  # int, the Newton steps or sweeps of the last radii solve
+        #self.packing_residual = []  # float, the largest angle residual left by the last radii solve
+        #self.packing_status = []  # dict, how the last radii solve ended, see update
         """
         Initialize the circle packing based on preset triangulation.  
         
@@ -62,37 +96,36 @@ class BridgeHoleDesign:
         # generate the triangulation of the bridge hole in ellipitical shape
         # with a point gap as delta
         self._tri = _generate_triangulation(self.l, self.h, self.a_ell, self.b_ell, self.delta)
-        # create the circle packing based on the triangulation created above
-        self.rld, self.raccb, self.ri, self.r, self._LD, self._AccB, self._ci, self._AD, self._circles, self._faces, self._cb, self._anchor_x, self._anchor_y, self._cb_origin = \
-            _generate_circlepacking(self._tri, self.delta, self.eps, self.delta_r)
+        # create the circle packing based on the triangulation created above, always with
+        # the fixed step sweeps so the initial design does not depend on packing_solver
+        self._packing = _generate_circlepacking(self._tri, self.delta, self.eps, self.delta_r)
+        # the radii and positions are views of the packing arrays, updated in place
+        packing = self._packing
+        self.r = packing.radius
+        self.rld = packing.radius[packing.ld]
+        self.raccb = packing.radius[packing.accb]
+        self.ri = packing.radius[packing.ci]
+        self.positions_ld = packing.xy[packing.ld]
+        self.positions_accb = packing.xy[packing.accb]
+        self.positions_ci = packing.xy[packing.ci]
         # generate the boundary edges of the hole, which will be used in FEM
-        self._edges = _generate_boundary_edges(self._LD, self._circles,
-                                               self._faces, self._anchor_x,
-                                               self._anchor_y, self._cb_origin)
+        self._edges = _generate_boundary_edges(packing)
         # Using FEM, calculating the maximum stress and the area of the hole
-        self.sigma, self.area = _finite_element_analysis(
-            self._edges, self.nely, self.nelx, self.l, self.h)
+        self._analyse()
         # assuming the density is 1, calculating the mass of the bridge by deducting
         # the area of hole from the area of the rectangle
-        self.mass = self.l * self.h - _get_area_of_all(self._faces)
+        self.mass = self.l * self.h - _get_area_of_all(packing)
         # calculate the gradient of the mass respect to r, and rld
-        self.gmass_r, self.gmass_rld = _get_grad_mass(self.r, self._LD,
-                                                      self._circles)
+        self.gmass_r, self.gmass_rld = _get_grad_mass(packing)
         # get the surround angles of leading dancers
-        self.angles_ld = _get_surround_angles(self._LD)
+        self.angles_ld = _get_surround_angles(packing, packing.ld)
         # get the surround angles of boundary circles
-        self.angles_accb = _get_surround_angles(self._AccB)
+        self.angles_accb = _get_surround_angles(packing, packing.accb)
         # get the length of edges linking by leading dancers
-        self.total_length_ld, self.edges_ld = _get_edge_length(self._LD, 0)
+        self.total_length_ld, self.edges_ld = _get_edge_length(packing, packing.ld, 0)
         # get the length of edges linking by accompanying boundary dancers
         self.total_length_accb, self.edges_accb = _get_edge_length(
-            self._AccB, 0)
-        # get the positions of leading dancers
-        self.positions_ld = _get_positions(self._LD)
-        # get the positions of boundary circles
-        self.positions_accb = _get_positions(self._AccB)
-        # get the positions of interior circles
-        self.positions_ci = _get_positions(self._ci)
+            packing, packing.accb, 0)
         # hacky solution to converge initial circle packing
         self.update(self.rld)
 
@@ -105,36 +138,57 @@ class BridgeHoleDesign:
             
         # Returns:
             self.r: list of float, the updated radii list of all circles
-            self.sigma: float, the maximum stress of the updated design
+            self.sigma: float, the maximum stress of the updated design, over the load cases
+            sigma_cases: dict, load case -> float, the stress of every load case
             self.mass: float, the mass of the updated desigin
             self.gmass_r: list of float, the gradient of the mass respect to r
             self.gmass_rld: list of float, the gradient of the mass respect to rld
+            self.gsigma_rld: list of float, the gradient of sigma respect to rld (for the
+                worst load case), from an adjoint FEM solve, None unless sigma_gradient
             self.angles_ld: list of float, 
+            cg_iterations: int, the CG iterations of the FEM solve (0 for the direct solver)
+            fem_converged: bool, False when a CG solve of the FEM stopped at its iteration
+                limit, the design then gets the stress of invalid designs
+            packing_iterations: int, the Newton steps or fixed step sweeps of the radii
+                solve (see _calculate_radii)
+            packing_residual: float, the largest remaining angle residual of the radii solve
+            packing_status: dict, how the radii solve ended: 'status' ('converged',
+                'max_iterations', 'time_budget', 'diverged' or 'stagnated', see
+                _calculate_radii), 'converged' (bool), 'iterations', 'residual' and
+                'time' (seconds). A solve stopped early leaves the packing at the
+                previous design, which the rest of the data then describes.
+            self.von_mises_max: float, the largest element von Mises stress (MPa), over the
+                load cases
+            self.von_mises_pnorm: float, the p-norm of the element von Mises stresses (MPa),
+                over the load cases
+            von_mises_max_cases: dict, load case -> float, the largest element von Mises
+                stress of every load case
         """
+        packing = self._packing
+        r_old = packing.radius.copy()
+        start = time()
         # modify the cricle packing given a new radii of leading dancers
-        _modify_circlepacking(rld_new, self.raccb, self.ri, self.r, self._LD,
-                              self._AccB, self._ci, self._AD, self._circles,
-                              0.1 * self.eps, 0.1 * self.delta_r)
-        # modify the boudanry edge as the circle packing changes
-        _modify_boundary_edges(self._edges, self._LD, self._circles,
-                               self._faces, self._anchor_x, self._anchor_y,
-                               self._cb_origin)
-
-        self.sigma, self.area = _finite_element_analysis(
-            self._edges, self.nely, self.nelx, self.l, self.h)
-        self.mass = self.l * self.h - _get_area_of_all(self._faces)
-        self.gmass_r, self.gmass_rld = _get_grad_mass(self.r, self._LD, self._circles)
-        self.angles_ld = _get_surround_angles(self._LD)
-        self.angles_accb = _get_surround_angles(self._AccB)
-        self.total_length_ld, self.edges_ld = _get_edge_length(self._LD, 0)
+        self.packing_iterations, self.packing_residual, status = _modify_circlepacking(
+                rld_new, packing, 0.1 * self.eps, 0.1 * self.delta_r, self.packing_solver,
+                self.packing_max_iterations, self.packing_time_budget, self.packing_patience)
+        self.packing_status = {'status': status, 'converged': status == 'converged',
+                               'iterations': self.packing_iterations,
+                               'residual': self.packing_residual, 'time': time() - start}
+        if status != 'converged':
+            # the radii are not a packing, go back to the last one
+            packing.radius[:] = r_old
+        # modify the boudanry edge as the circle packing changes, which also moves the
+        # positions (views of the packing)
+        _modify_boundary_edges(self._edges, packing)
+
+        self._analyse()
+        self.mass = self.l * self.h - _get_area_of_all(packing)
+        self.gmass_r, self.gmass_rld = _get_grad_mass(packing)
+        self.angles_ld = _get_surround_angles(packing, packing.ld)
+        self.angles_accb = _get_surround_angles(packing, packing.accb)
+        self.total_length_ld, self.edges_ld = _get_edge_length(packing, packing.ld, 0)
         self.total_length_accb, self.edges_accb = _get_edge_length(
-            self._AccB, 0)
-        # get the positions of leading dancers
-        self.positions_ld = _get_positions(self._LD)
-        # get the positions of boundary circles
-        self.positions_accb = _get_positions(self._AccB)
-        # get the positions of all circles
-        self.positions_ci = _get_positions(self._ci)
+            packing, packing.accb, 0)
 
         geo = {
             'angles_ld': self.angles_ld,
@@ -155,10 +209,99 @@ class BridgeHoleDesign:
             'mass': self.mass,
             'gmass_r': self.gmass_r,
             'gmass_rld': self.gmass_rld,
+            'gsigma_rld': self.gsigma_rld,
+            'cg_iterations': self._solver_state.iterations,
+            'packing_iterations': self.packing_iterations,
+            'packing_residual': self.packing_residual,
+            'packing_status': self.packing_status,
+            'infeasible': self._fem_info['infeasible'],
+            'fem_converged': self._fem_info['converged'],
+            'von_mises_max': self.von_mises_max,
+            'von_mises_pnorm': self.von_mises_pnorm,
+            'sigma_cases': dict(zip(self.load_cases, self.sigma_cases)),
+            'von_mises_max_cases': dict(zip(self.load_cases, self.von_mises_max_cases)),
             'geometry_info': geo
         }
         return data
 
+    def _analyse(self):
+        """
+        Run the FEM analysis of the current edges for all load cases and keep the
+        stresses of every case and of the worst one. With sigma_gradient also keep the
+        gradient of the worst sigma with respect to the radii of the leading dancers.
+        """
+        self.sigma_cases, self.area, self._fem_info = _finite_element_analysis(
+            self._edges, self.nely, self.nelx, self.l, self.h, self.solver,
+            self._solver_state, full_output=True, loads=self.load_cases,
+            gradient=self.sigma_gradient,
+            cache=self.fem_cache, compliance_limit=self.compliance_limit,
+            density=self.density, ordering=self.ordering, mesh_type=self.mesh_type)
+        self.von_mises_max_cases = self._fem_info['von_mises_max']
+        worst = np.argmax(self.sigma_cases)
+        self.sigma = self.sigma_cases[worst]
+        self.gsigma_rld = None
+        if self.sigma_gradient:
+            gedges = _get_grad_edges(self._packing)
+            self.gsigma_rld = np.einsum('ik,ikj->j', self._fem_info['gsigma_edges'][worst],
+                                        gedges).tolist()
+        self.von_mises_max = np.max(self.von_mises_max_cases)
+        self.von_mises_pnorm = np.max(self._fem_info['von_mises_pnorm'])
+
+    def sweep(self, load_scales=(1.0,), moduli=(E0,),
+              allowable_stresses=(CONFIG['allowable_stress'],)):
+        """
+        The results of the current design for a whole grid of load magnitudes, Young's
+        moduli and allowable stresses, from the last FEM solve alone (see _FEM._rescale).
+        The compliance scales with load^2/E^2 and the stresses with the load, exactly
+        while Emin is negligible; the error Emin causes is reported for every modulus.
+        Invalid and infeasible designs keep the stress 2**16 - 1 everywhere.
+
+        # Arguments:
+            load_scales: list of float, the factors of the load cases
+            moduli: list of float, the Young's moduli E0
+            allowable_stresses: list of float, the thresholds sigma is checked against
+
+        # Returns:
+            dict of
+            'sigma': (n_loads, n_moduli) float array, the worst case sigma
+            'sigma_cases': (n_loads, n_moduli, n_cases) float array
+            'von_mises_max', 'von_mises_pnorm': (n_loads, n_moduli) float arrays, over
+                the load cases
+            'feasible': (n_loads, n_moduli, n_allowable) bool array, sigma below the
+                allowable stress
+            'stress_ratio': (n_loads, n_moduli, n_allowable) float array,
+                (allowable_stress - sigma) / allowable_stress
+            'sigma_error', 'stress_error': (n_moduli,) float arrays, the estimated
+                relative errors of the rescaled sigma and stresses, worst case
+
+        # Example
+            bridge = BridgeHoleDesign()
+            grid = bridge.sweep(load_scales=[0.5, 1, 2], moduli=[7e10, 2e11])
+        """
+        n_loads, n_moduli = len(load_scales), len(moduli)
+        info = self._fem_info
+        if 'U' in info:
+            sigma_cases, von_mises_max, von_mises_pnorm, error = _rescale(
+                    _get_mesh(self.nely, self.nelx), info['x'], info['U'],
+                    self.sigma_cases, info['von_mises'], load_scales, moduli)
+            von_mises_max = np.max(von_mises_max, axis=-1)
+            von_mises_pnorm = np.max(von_mises_pnorm, axis=-1)
+            error = np.max(error, axis=-1)
+        else:
+            sigma_cases = np.full((n_loads, n_moduli, len(self.load_cases)), 2**16 - 1.0)
+            von_mises_max = von_mises_pnorm = np.full((n_loads, n_moduli), 2**16 - 1.0)
+            error = np.zeros(n_moduli)
+        sigma = np.max(sigma_cases, axis=-1)
+        allowable = np.asarray(allowable_stresses, dtype=float)
+        return {'sigma': sigma,
+                'sigma_cases': sigma_cases,
+                'von_mises_max': von_mises_max,
+                'von_mises_pnorm': von_mises_pnorm,
+                'feasible': sigma[..., None] < allowable,
+                'stress_ratio': (allowable - sigma[..., None]) / allowable,
+                'sigma_error': 2 * error,
+                'stress_error': error}
+
     def render(self, edges = True, circles = True):
         fig, ax = plt.subplots()
         plt.axis('equal')
@@ -167,10 +310,10 @@ class BridgeHoleDesign:
             ax.set_xlim((0, self.l))
             ax.set_ylim((0, self.h))
 
-            for c in self._circles:
-                #ax.add_artist(plt.Circle((c.x, c.y), c.radius, color='g'))
-                ax.add_artist(plt.Circle((c.x, c.y),
-                              c.radius,
+            for (x, y), radius in zip(self._packing.xy, self._packing.radius):
+                #ax.add_artist(plt.Circle((x, y), radius, color='g'))
+                ax.add_artist(plt.Circle((x, y),
+                              radius,
                               edgecolor='orange',
                               alpha=.5,
                               fill=False))
@@ -197,7 +340,7 @@ class BridgeHoleDesign:
         """
         draw the circle packing
         """
-        _draw_circles(self._circles, self.l)
+        _draw_circles(self._packing, self.l)
 
     def draw_triangulation(self):
         """
@@ -206,7 +349,10 @@ class BridgeHoleDesign:
         _draw_triangulation(self._tri)
 
 
-def _finite_element_analysis(edges, nely, nelx, l, h):
+def _finite_element_analysis(edges, nely, nelx, l, h, solver='cg', state=None,
+                             full_output=False, loads=None, gradient=False, cache=None,
+                             compliance_limit=None, density='sample', ordering=None,
+                             mesh_type='uniform'):
     """
     If there are parts of edges exceeding the design domain, return infinity 
     for stress, else calls _FEM 
@@ -217,38 +363,114 @@ def _finite_element_analysis(edges, nely, nelx, l, h):
     nelx: int, number of elements in x direction
     l: float, the length of the rectangle design domain
     h: float, the height of the rectangle design domain
+    solver: str, the FEM linear solver backend (see _FEM)
+    state: _SolverState or None, the solver state kept between calls (see _FEM)
+    full_output: True to also return the dict of element fields of _FEM. For invalid
+        and infeasible designs, and those whose CG solve did not converge, it only
+        holds 'infeasible', 'converged', 'von_mises_max' and 'von_mises_pnorm', both
+        2**16 - 1. Designs with an unconverged adjoint solve also get that stress.
+    loads: list of str or None, the load cases (see _FEM)
+    gradient: True to add the sensitivities of sigma to the full_output dict (see _FEM).
+        They are 0 for invalid designs.
+    cache: _FEMCache or None, the solutions of earlier density fields (see _FEM).
+        Invalid designs are not looked up.
+    compliance_limit: float or None, the largest work of the load F.U a design may
+        take (see _FEM). Designs proven to exceed it are infeasible: the solve stops
+        early and they get the stress of invalid designs, with the true area.
+    density: str, how the hole is rasterized, 'sample' or 'coverage' (see _FEM)
+    ordering: str or None, the order of the free dofs in the solve, 'rcm' or 'nd' (see _FEM)
+    mesh_type: str, the FEM mesh, 'uniform' or 'adaptive' (see _FEM)
     
     # Returns:
-    sigma: float, the maximal stress of the bridge under loading
+    sigma: float, the maximal stress of the bridge under loading, a (len(loads),)
+        array when loads are given
     area: float, the area of the bridge
     """
+    if state is not None:
+        state.iterations = 0
+    if not _valid_edges(edges, nely, nelx, l, h):
+        # todo - sigma = np.inf is ideal,
+        # sigma = 2**16 - 1 large constant is a temporary measure to prevent NaN
+        sigma = 2**16 - 1
+        if loads is not None:
+            sigma = np.full(len(loads), sigma, dtype=float)
+        area = l * h
+        if full_output:
+            info = {'infeasible': False, 'converged': True,
+                    'von_mises_max': sigma, 'von_mises_pnorm': sigma}
+            if gradient:
+                info['gsigma_edges'] = np.zeros(np.shape(sigma) + np.shape(edges))
+            return sigma, area, info
+        return sigma, area
+
+    result = _FEM(edges, nely, nelx, False, solver, state, full_output, loads, gradient,
+                  cache, compliance_limit, density, ordering, mesh_type)
+    unsolved = full_output and not result[2]['converged']
+    if np.all(np.isfinite(result[0])) and not unsolved:
+        return result
+    # infeasible or not solved, the same large constant as for invalid designs
+    sigma = np.where(np.isinf(result[0]) | unsolved, 2**16 - 1, result[0])
+    if loads is None:
+        sigma = float(sigma)
+    if full_output:
+        result[2]['von_mises_max'] = result[2]['von_mises_pnorm'] = sigma
+        return sigma, result[1], result[2]
+    return sigma, result[1]
+
+
+def _finite_element_analysis_batch(edges, nely, nelx, l, h, solver='cg'):
+    """
+    _finite_element_analysis for a stack of designs on the same mesh. The valid designs
+    are analysed together by _FEM_batch; the invalid ones, and those whose solve did
+    not converge, get the same large stress as in _finite_element_analysis.
+    
+    # Arguments:
+    edges: (n_designs, n, 5) float array, a stack of edge sets
+    nely, nelx, l, h: see _finite_element_analysis
+    solver: str, the FEM linear solver backend (see _FEM_batch)
+    
+    # Returns:
+    sigma: (n_designs,) float array
+    area: (n_designs,) float array
+    """
+    edges = np.asarray(edges, dtype=float)
+    sigma = np.full(len(edges), 2**16 - 1, dtype=float)
+    area = np.full(len(edges), l * h, dtype=float)
+    valid = np.array([_valid_edges(e, nely, nelx, l, h) for e in edges], dtype=bool)
+    if valid.any():
+        sigma[valid], area[valid] = _FEM_batch(edges[valid], nely, nelx, solver=solver)
+    sigma[np.isinf(sigma)] = 2**16 - 1
+    return sigma, area
+
+
+def _valid_edges(edges, nely, nelx, l, h):
+    """
+    Check that the hole keeps at least an element away from the sides of the design
+    domain and that its boundary does not cross itself.
+    
+    # Arguments:
+    edges, nely, nelx, l, h: see _finite_element_analysis
+    
+    # Returns:
+    Bool: True if the edges can be analysed by _FEM
+    """
     eps_x = l / nelx
     eps_y = h / nely
     
     if edges[-1][3] > l - 1 * eps_x or edges[-1][4] > h - 1 * eps_y:
         # Distance between hole and rectangle is smaller than the size of an element,
         print("  Bridge: Distance between hole and rectangle is smaller than the size of an element.")
-        # todo - sigma = np.inf is ideal,
-        # sigma = 2**16 - 1 large constant is a temporary measure to prevent NaN
-        sigma = 2**16 - 1
-        area = l * h
-        return sigma, area
+        return False
     
     for e in edges:
         if e[1] > l - 1 * eps_x or e[2] > h - 1 * eps_y:
             print("  Bridge: Distance between hole and rectangle is smaller than the size of an element.")
-            sigma = 2**16 - 1
-            area = l * h
-            return sigma, area 
+            return False
     
     if _crossing_boundary(edges) == True:
         print("  Bridge: Hole shape invalid.")
-        sigma = 2**16 - 1
-        area = l * h
-        return sigma, area 
-    
-    sigma, area = _FEM(edges, nely, nelx, False)
-    return sigma, area
+        return False
+    return True
 
 def _crossing_boundary(edges):
     for i in range(len(edges)-2):
@@ -288,126 +510,87 @@ def _get_area_ri(ri, rj, rk):
     by the triple (ri, rj, rk) repsect to ri
     
     # Arguments:
-        ri: float, the radius 
-        rj: float, the radius
-        rk: float, the radius
+        ri: float or float array, the radius 
+        rj: float or float array, the radius
+        rk: float or float array, the radius
         
     # Return:
         the partial defference of the area respect to ri
     """
-    return rj * rk * (2 * ri + rj + rk) / (2 * sqrt(ri * rj * rk *
-                                                       (ri + rj + rk)))
+    return rj * rk * (2 * ri + rj + rk) / (2 * np.sqrt(ri * rj * rk *
+                                                          (ri + rj + rk)))
 
 
-def _get_grad_mass(r, LD, circles):
+def _get_grad_mass(packing):
     """
     calculate the gradient of mass respect to radii of circles
     
     # Arguments
-        r: list of float, the radii list of all circles
-        LD: list of _CircleVertex, the collectin of leading dancers
-        circles: list of _CircleVertex, the collection of all circles
+        packing: _Packing, the circle packing
         
     # Returns:
-        gmass_r: list of float, the gradient of mass respect the radii of all 
+        gmass_r: float array, the gradient of mass respect the radii of all 
                  circles
-        gmass_rld: list of float, the gradient of mass respect to radii of leading
-                    dancers        
-    """
-    gmass_r = [0] * len(r)
-    for i_r in range(len(r)):
-        # the partial derivative of hole area respect ri is the sum of the partial derivative
-        # of the area of triangles that include ri respect ri. These trianges are the trianges
-        # surrounding circles[i], which can be found be the neighbors of circles[i]
-        for i_n in range(len(circles[i_r].neighbors) - 1):
-            ri = r[i_r]
-            rj = circles[i_r].neighbors[i_n].radius
-            rk = circles[i_r].neighbors[i_n + 1].radius
-            gmass_r[i_r] = gmass_r[i_r] - _get_area_ri(ri, rj, rk)
-    gmass_rld = [0] * len(LD)
-    for i in range(len(LD)):
-        gmass_rld[i] = gmass_r[LD[i].index]
-    return gmass_r, gmass_rld
-
-
-def _get_area_of_all(faces):
+        gmass_rld: float array, the gradient of mass respect to radii of leading
+                    dancers, a view of gmass_r
+    """
+    # the partial derivative of hole area respect ri is the sum of the partial derivative
+    # of the area of triangles that include ri respect ri. These trianges are the trianges
+    # surrounding circle i, its corners (i, j, k)
+    r = packing.radius
+    i, j, k = packing.corners.T
+    gmass_r = -np.bincount(i, weights=_get_area_ri(r[i], r[j], r[k]), minlength=len(r))
+    return gmass_r, gmass_r[packing.ld]
+
+
+def _get_area_of_all(packing):
     """
     calculate the area of the hole by summing up the are of all triangles
     
     # Arguments
-        faces: list of _Face, the faces of the triangulation
+        packing: _Packing, the circle packing
         
     # Returns:
         s: float, the area
     """
-    s = 0
-    for f in faces:
-        ri = f.vertex1.radius
-        rj = f.vertex2.radius
-        rk = f.vertex3.radius
-        a = ri + rj
-        b = rj + rk
-        c = rk + ri
-        s += sqrt((ri + rj + rk)*rk*ri*rj)
-    return s
+    r = packing.radius[packing.faces]
+    ri, rj, rk = r[:, 0], r[:, 1], r[:, 2]
+    return float(np.sum(np.sqrt((ri + rj + rk)*rk*ri*rj)))
 
 
-def _get_surround_angles(Cir):
+def _get_surround_angles(packing, circles):
     """
     Get the surround angles of a set of circles
     
     # Arguments:
-    Cir: _CircleVertex array, the circle set
+    packing: _Packing, the circle packing
+    circles: slice or int array, the circle set
     
     # Returns:
-    ang: float array, the array of the surround angle of the given circles
+    ang: float array, the surround angle of the given circles
     """
-    ang = [0] * len(Cir)
-    for i in range(len(Cir)):
-        ang[i] = _theta_arround(Cir[i])
-    return ang
+    return _angle_sums(packing)[0][circles]
 
 
-def _get_edge_length(Cir, closed):
+def _get_edge_length(packing, circles, closed):
     """
     Get the total length of the part of boundary linking by a set of circles and the lengths of the
     segments on the part boudnary
     
     # Arguments: 
-    Cir: _CircleVertex array, the set of circles on the boundary
+    packing: _Packing, the circle packing
+    circles: slice or int array, the set of circles on the boundary, in order
     closed: Bool, denote whether the set of circles are linked into a closed curve
     
     # Returns:
     total: float, the total length of the part of boundary
     edge_list: float array, the lengths of the segments linked between the circles 
     """
-    edge_list = [0] * (len(Cir) - 1)
-    total = 0
-    for i in range(len(Cir) - 1):
-        edge_list[i] = Cir[i].radius + Cir[i + 1].radius
-        total += Cir[i].radius + Cir[i + 1].radius
+    r = packing.radius[circles]
+    edge_list = r[:-1] + r[1:]
     if closed:
-        edge_list.append(Cir[0].radius + Cir[-1].radius)
-        total += Cir[0].radius + Cir[-1].radius
-    return total, edge_list
-
-
-def _get_positions(Cir):
-    """
-    Get the positions of a set of circles
-    
-    # Arguments:
-    Cir: _CircleVertex array, the circle set
-    
-    # Returns:
-    p: float array, nx[x,y], n is the number of circles. x and y are the coordinates
-    of the centers of the circles
-    """
-    p = np.zeros((len(Cir), 2))
-    for i in range(len(Cir)):
-        p[i][0] = Cir[i].x
-        p[i][1] = Cir[i].y
-    return p
+        edge_list = np.append(edge_list, r[0] + r[-1])
+    return float(np.sum(edge_list)), edge_list
 
 
 class _CircleVertex:
@@ -430,8 +613,6 @@ class _CircleVertex:
         self.incident_halfedge = []
         # the set of all of neighbors of the circle
         self.neighbors = []
-        # whether the circle is placed or not
-        self.placed = 0
         # the index of the circle in th list of circles
         self.index = i
         self.radius = r
@@ -503,6 +684,77 @@ class _Face:
             self.vertex3.incident_halfedge = self.halfedge3
 
 
+class _Packing:
+    """
+    The circle packing as flat arrays. The circles are numbered leading dancers first,
+    then the accompanying boundary dancers in boundary order, then the interior
+    circles, so every group is a slice and its radii and centers are views of radius
+    and xy. The neighbor fans are kept in CSR form, and the order in which
+    _layout_circles places the circles, which only depends on the topology, is
+    worked out once. It is built from the _CircleVertex graph that
+    _generate_circlepacking derives the topology with.
+
+    # Properties
+        radius: (n,) float array, the radii
+        xy: (n, 2) float array, the centers
+        total_angle: (n,) float array, the prescribed surround angles
+        point: (n,) int array, the triangulation point of every circle
+        fan_ptr, fan_index: int arrays, the neighbors of circle i in ccw order are
+            fan_index[fan_ptr[i]:fan_ptr[i + 1]] (see fan). The fans of interior
+            circles are closed, their first neighbor is repeated at the end
+        corners: (n_corners, 3) int array, (i, j, k) for every two consecutive
+            neighbors j, k of circle i, the triangles whose angles at i sum up to its
+            surround angle
+        faces: (n_faces, 3) int array, the circles of every face
+        n_ld, n_accb, n_ci: int, the number of leading dancers, accompanying boundary
+            dancers and interior circles
+        ld, accb, ci, ad: slices, the leading dancers, the accompanying boundary
+            dancers, the interior circles and all accompanying dancers (accb and ci)
+        cb: int array, the boundary circles in ccw order, cb[0] == cb[-1]
+        anchor_x, anchor_y: int arrays, the circles lying along the x and y axis
+        origin: int, the circle lying on the origin
+        layout: (n_placed, 3) int array, (i, j, k) in the order _layout_circles places
+            circle k next to the placed circles i and j
+
+    # Example
+        packing = _Packing(circles, faces, cb, LD, ci, anchor_x, anchor_y, origin)
+        packing.radius[packing.ld] = rld
+    """
+    def __init__(self, circles, faces, cb, LD, ci, anchor_x, anchor_y, origin):
+        AccB = [c for c in cb[:-1] if not _in_circles(c, LD)]
+        order = [c.index for c in LD + AccB + ci]
+        number = np.empty(len(circles), dtype=int)
+        number[order] = np.arange(len(order))
+        self.n_ld, self.n_accb, self.n_ci = len(LD), len(AccB), len(ci)
+        self.ld = slice(0, self.n_ld)
+        self.accb = slice(self.n_ld, self.n_ld + self.n_accb)
+        self.ci = slice(self.n_ld + self.n_accb, len(order))
+        self.ad = slice(self.n_ld, len(order))
+        self.point = np.array(order)
+        self.radius = np.array([circles[i].radius for i in order], dtype=float)
+        self.xy = np.array([(circles[i].x, circles[i].y) for i in order], dtype=float)
+        self.total_angle = np.array([circles[i].totall_angle for i in order], dtype=float)
+
+        fans = [number[[c.index for c in circles[i].neighbors]] for i in order]
+        self.fan_ptr = np.concatenate(([0], np.cumsum([len(fan) for fan in fans])))
+        self.fan_index = np.concatenate(fans)
+        self.corners = np.concatenate(
+                [np.stack((np.full(len(fan) - 1, i), fan[:-1], fan[1:]), axis=1)
+                 for i, fan in enumerate(fans)])
+        self.faces = number[[[f.vertex1.index, f.vertex2.index, f.vertex3.index]
+                             for f in faces]]
+        self.cb = number[[c.index for c in cb]]
+        self.anchor_x = number[[c.index for c in anchor_x]]
+        self.anchor_y = number[[c.index for c in anchor_y]]
+        self.origin = int(number[origin.index])
+        self.layout = _layout_order(self.faces,
+                                    np.concatenate((self.anchor_x, self.anchor_y)))
+
+    def fan(self, i):
+        """The neighbors of circle i in ccw order."""
+        return self.fan_index[self.fan_ptr[i]:self.fan_ptr[i + 1]]
+
+
 def _in_circles(c, Cir):
     """Determine whether _CircleVertex c in list of _CircleVertex Cir.
 
@@ -524,30 +776,74 @@ def _in_circles(c, Cir):
     return False
 
 
-def _theta_arround(cv):
-    """Calculate the surround angle of a circle vertex cv
+def _theta_arround(r, i, fan):
+    """Calculate the surround angle of circle i
     
     # Arguments
-        cv: Instance of _CircleVertex
+        r: list of float, the radii of all circles
+        i: int, the circle
+        fan: list of int, the neighbors of i in ccw order (see _Packing.fan)
 
     # Returns
-        theta, Float, the surround angle of cv. 
+        theta, Float, the surround angle of circle i. 
 
     # Example
-        c = _CircleVertex(1,1,0,0,0)
-        theta = _theta_arround(c)
-        If c is an interior in a circle packing, theta should be 2*pi
+        r = packing.radius.tolist()
+        theta = _theta_arround(r, i, packing.fan(i).tolist())
+        If i is an interior circle in a circle packing, theta should be 2*pi
 
     """
-    r = cv.radius
+    ri = r[i]
     theta = 0
-    for i in range(len(cv.neighbors) - 1):
-        rj = cv.neighbors[i].radius
-        rk = cv.neighbors[i + 1].radius
-        theta += acos(((r + rj)**2 + (r + rk)**2 - (rj + rk)**2)/(2 * (r + rj) * (r + rk)))
+    for n in range(len(fan) - 1):
+        rj = r[fan[n]]
+        rk = r[fan[n + 1]]
+        theta += acos(((ri + rj)**2 + (ri + rk)**2 - (rj + rk)**2)/(2 * (ri + rj) * (ri + rk)))
     return theta
 
 
+def _angle_sums(packing, corners=None, radius=None):
+    """
+    The surround angles of all circles in one pass: the angles of the corners (i, j, k)
+    of the packing (see _theta_arround) are computed together and summed per circle.
+
+    # Arguments
+        packing: _Packing, the circle packing
+        corners: int array or None, the rows of packing.corners to sum, e.g. those of
+            a subset of the circles; None for all
+        radius: (n,) float array or None, the radii to use instead of packing.radius
+
+    # Returns
+        theta: (n,) float array, the surround angles, 0 for circles without corners
+        residual: (n,) float array, theta - packing.total_angle
+    """
+    r = packing.radius if radius is None else radius
+    i, j, k = (packing.corners if corners is None else packing.corners[corners]).T
+    ri, rj, rk = r[i], r[j], r[k]
+    alpha = np.arccos(((ri + rj)**2 + (ri + rk)**2 - (rj + rk)**2) / (2 * (ri + rj) * (ri + rk)))
+    theta = np.bincount(i, weights=alpha, minlength=len(r))
+    return theta, theta - packing.total_angle
+
+
+def _angle_jacobian(packing, corners=None, radius=None):
+    """
+    The derivatives of the surround angles of all circles with respect to all radii,
+    summed from the derivatives of the corner angles (see _corner_angles).
+
+    # Arguments
+        packing, corners, radius: see _angle_sums
+
+    # Returns
+        J: (n, n) csr_matrix, J[i, j] is the derivative of the surround angle of
+            circle i with respect to the radius of circle j
+    """
+    r = packing.radius if radius is None else radius
+    c = packing.corners if corners is None else packing.corners[corners]
+    alpha, d_ri, d_rj, d_rk = _corner_angles(r[c[:, 0]], r[c[:, 1]], r[c[:, 2]])
+    return csr_matrix((np.concatenate((d_ri, d_rj, d_rk)),
+                       (np.tile(c[:, 0], 3), c.T.reshape(-1))), shape=(len(r), len(r)))
+
+
 def _generate_triangulation(l = 20, h = 10, a_ell = 18, b_ell = 8, delta = 1):
     """The bridge has an elliptical hole
     discrete the elliptical hole with uniformed points in delta distance
@@ -789,41 +1085,237 @@ def _calculate_ld_surround_angles(LD):
         LD[j].totall_angle = surround_angle
 
 
-def _calculate_radii(circles, eps, delta_r, leavingout=[]):
+# the fixed step sweeps of _calculate_radii have diverged once the largest residual
+# grew to this many times the smallest one seen
+_PACKING_DIVERGENCE = 10.0
+# and stagnated once patience sweeps did not take it this fraction below where it
+# was at the start of them
+_PACKING_PROGRESS = 0.01
+# a converged Newton solve of the radii takes at most this many more steps to get
+# its residual down to _NEWTON_POLISH, close to the rounding of the angle sums
+_NEWTON_POLISH = 1e-12
+_NEWTON_POLISH_ITERATIONS = 5
+
+
+def _calculate_radii(packing, circles, eps, delta_r, leavingout=None, method='newton',
+                     max_iterations=None, time_budget=None, patience=None):
     """Calculate the radii of circles by adjusting radii untill the
     surround_angles of each circle are equal with the totall anges that
     prescribe at first
     If all the radii of boundary circle are undertmined, must leaving one boundary
     circle out.
 
-    TODO - Update explanation, comments within code.
+    With method 'fixed_step' every radius is moved by delta_r times itself, up or
+    down with the sign of its residual (see _angle_sums), one sweep after the other.
+    This is first order with a fixed step and needs thousands of sweeps for small
+    delta_r. 'newton' takes damped Newton steps instead (see _newton_radii) and
+    continues with the fixed steps from where it stopped if it fails to converge.
+    Once within eps the Newton solve is polished down to _NEWTON_POLISH, so the
+    radii no longer depend on where it started: a few more quadratic steps.
+    'local' only relaxes the circles whose residual is above eps, one at a time
+    (see _local_radii), so after a small change of a few radii the work follows how
+    far the change spreads instead of the size of the packing.
+
+    Without the budgets the solve runs until the residuals are within eps, which
+    for a bad rld may never happen. With them it stops early and says why: after
+    max_iterations Newton steps and sweeps, after time_budget seconds, when the
+    residual of the sweeps diverges (grows to _PACKING_DIVERGENCE times its
+    smallest value, or the radii overflow), or when it stagnates (patience sweeps
+    in a row without taking it _PACKING_PROGRESS below where they started).
 
     # Arguments
-        circles: list of _CircleVertex
+        packing: _Packing, the circle packing, its radius is updated in place
+        circles: slice or int array, the circles whose radii are calculated, the
+            others (e.g. the leading dancers) are kept
         eps: float, error tolerate 
-        delta_r: float, the magnitude of radii change in each iteration
-        leavingout: _CircleVertex, one of the boundary circle
+        delta_r: float, the magnitude of radii change in each iteration of 'fixed_step'
+        leavingout: int or None, one of the boundary circle, kept as it is
+        method: str, 'newton', 'fixed_step' or 'local'
+        max_iterations: int or None, the most Newton steps and sweeps, or single
+            circle relaxations of 'local', to take
+        time_budget: float or None, the most wall clock seconds to take, checked
+            once per Newton step, sweep or relaxation
+        patience: int or None, the sweeps without progress before giving up, None
+            to never detect stagnation (divergence is always detected)
 
-    # Example
+    # Returns
+        iterations: int, the Newton steps and fixed step sweeps, or the circle
+            relaxations of 'local', taken
+        residual: float, the largest remaining |theta - total_angle| of the circles
+        status: str, 'converged' (residual <= eps), 'max_iterations', 'time_budget',
+            'diverged' or 'stagnated'
     """
-    n_c = len(circles)
+    if method not in ('newton', 'fixed_step', 'local'):
+        raise ValueError("Unknown method %r, expected 'newton', 'fixed_step' or 'local'"
+                         % (method,))
+    deadline = None if time_budget is None else time() + time_budget
+    r = packing.radius
+    index = np.arange(len(r))[circles]
+    index = index[index != leavingout]
+    # the corners of these circles, the terms of their surround angles
+    corners = np.flatnonzero(np.isin(packing.corners[:, 0], index))
+    if method == 'local':
+        return _local_radii(packing, index, corners, eps, max_iterations, deadline)
+    iterations = 0
+    if method == 'newton':
+        newton_iterations = 50 if max_iterations is None else min(50, max_iterations)
+        iterations, residual = _newton_radii(packing, index, corners, eps,
+                                             newton_iterations, deadline)
+        if residual <= eps:
+            polish, residual = _newton_radii(packing, index, corners, _NEWTON_POLISH,
+                                             _NEWTON_POLISH_ITERATIONS, deadline)
+            return iterations + polish, residual, 'converged'
     # theta_diff: The difference between the expected angle and actual angle
-    theta_diff = [0] * n_c
-    for i in range(n_c):
-        if circles[i].index != leavingout.index:
-            theta_diff[i] = _theta_arround(circles[i]) - circles[i].totall_angle
-    
-    while np.max(theta_diff) > eps or np.min(theta_diff) < -eps:
-        for i in range(n_c):
-            if theta_diff[i] < 0:
-                if circles[i].index != leavingout.index:
-                    circles[i].radius = circles[i].radius - delta_r * circles[i].radius
-            elif theta_diff[i] > 0:
-                if circles[i].index != leavingout.index:
-                    circles[i].radius += delta_r * circles[i].radius
-        for i in range(n_c):
-            if circles[i].index != leavingout.index:
-                theta_diff[i] = _theta_arround(circles[i]) - circles[i].totall_angle
+    theta_diff = _angle_sums(packing, corners)[1][index]
+    norm = np.max(np.abs(theta_diff), initial=0)
+    # the residual history: the smallest residual, and where the current stretch
+    # of patience sweeps started
+    best = start = norm
+    since_start = 0
+    status = 'converged'
+    while not norm <= eps:  # a nan residual is not converged either
+        if not (np.isfinite(norm) and norm <= _PACKING_DIVERGENCE * best):
+            status = 'diverged'
+            break
+        if max_iterations is not None and iterations >= max_iterations:
+            status = 'max_iterations'
+            break
+        if deadline is not None and time() > deadline:
+            status = 'time_budget'
+            break
+        if patience is not None and since_start >= patience:
+            status = 'stagnated'
+            break
+        shrink = index[theta_diff < 0]
+        grow = index[theta_diff > 0]
+        r[shrink] = r[shrink] - delta_r * r[shrink]
+        r[grow] += delta_r * r[grow]
+        theta_diff = _angle_sums(packing, corners)[1][index]
+        norm = np.max(np.abs(theta_diff), initial=0)
+        iterations += 1
+        best = min(best, norm)
+        if norm < (1 - _PACKING_PROGRESS) * start:
+            start, since_start = norm, 0
+        else:
+            since_start += 1
+    return iterations, float(norm), status
+
+
+def _newton_radii(packing, index, corners, eps, max_iterations=50, deadline=None):
+    """
+    Damped Newton iteration for the radii of the circles index, in log radius so the
+    radii stay positive: the step solves J dlog(r) = -residual with the sparse
+    Jacobian of their surround angles (see _angle_jacobian), and is halved until the
+    largest residual goes down. Stops when it is at most eps, after max_iterations,
+    past the deadline, or when no step length down to 1/1024 decreases it.
+
+    # Arguments
+        packing: _Packing, the circle packing, its radius is updated in place
+        index: int array, the circles whose radii are solved
+        corners: int array, the rows of packing.corners around these circles
+        eps: float, the tolerance of the residuals
+        max_iterations: int, the most Newton steps to take
+        deadline: float or None, the time() after which no further step is taken
+
+    # Returns
+        iterations: int, the Newton steps taken
+        residual: float, the largest remaining |theta - total_angle|
+    """
+    r = packing.radius
+    residual = _angle_sums(packing, corners)[1][index]
+    norm = np.max(np.abs(residual), initial=0)
+    iterations = 0
+    while norm > eps and iterations < max_iterations:
+        if deadline is not None and time() > deadline:
+            break
+        J = _angle_jacobian(packing, corners)[index][:, index] @ diags(r[index])
+        try:
+            step = -splu(J.tocsc()).solve(residual)
+        except RuntimeError:  # singular Jacobian
+            break
+        r_old = r[index]
+        t = 1.0
+        while t >= 2**-10:
+            r[index] = r_old * np.exp(t * step)
+            residual_new = _angle_sums(packing, corners)[1][index]
+            norm_new = np.max(np.abs(residual_new))
+            if norm_new < norm:
+                break
+            t /= 2
+        else:
+            r[index] = r_old
+            break
+        residual, norm = residual_new, norm_new
+        iterations += 1
+    return iterations, float(norm)
+
+
+def _local_radii(packing, index, corners, eps, max_iterations=None, deadline=None):
+    """
+    Relax the circles index one at a time, the largest residual first, until all of
+    their residuals are at most eps. The circles above eps are kept in a priority
+    queue. A relaxed circle gets the radius whose surround angle would be its total
+    angle if all of its k neighbors had the same radius (the uniform neighbor model:
+    with beta = sin(theta / 2k) the neighbors are r beta / (1 - beta) large), and
+    then it and its neighbors get their residuals recomputed from their fans and are
+    queued if they are above eps. The residuals of all the circles are computed
+    once up front. After that the work only depends on how far a change spreads.
+
+    # Arguments
+        packing: _Packing, the circle packing, its radius is updated in place
+        index: int array, the circles whose radii are solved
+        corners: int array, the rows of packing.corners around these circles
+        eps: float, the tolerance of the residuals
+        max_iterations: int or None, the most circle relaxations to take
+        deadline: float or None, the time() after which no further circle is relaxed
+
+    # Returns
+        iterations, residual, status: see _calculate_radii, iterations counts the
+            circle relaxations
+    """
+    r = packing.radius
+    # the radii, residuals and fans as lists, faster to index one at a time
+    radius = r.tolist()
+    total = packing.total_angle.tolist()
+    fans = [fan.tolist() for fan in np.split(packing.fan_index, packing.fan_ptr[1:-1])]
+    solved = np.zeros(len(r), dtype=bool)
+    solved[index] = True
+    solved = solved.tolist()
+    residual = np.zeros(len(r))
+    residual[index] = _angle_sums(packing, corners)[1][index]
+    residual = residual.tolist()
+    queue = [(-abs(residual[i]), i) for i in index.tolist() if abs(residual[i]) > eps]
+    heapq.heapify(queue)
+    queued = [False] * len(r)
+    for _, i in queue:
+        queued[i] = True
+    iterations = 0
+    status = 'converged'
+    while queue:
+        if max_iterations is not None and iterations >= max_iterations:
+            status = 'max_iterations'
+            break
+        if deadline is not None and time() > deadline:
+            status = 'time_budget'
+            break
+        i = heapq.heappop(queue)[1]
+        queued[i] = False
+        fan = fans[i]
+        k = 2 * (len(fan) - 1)
+        beta = sin((residual[i] + total[i]) / k)
+        delta = sin(total[i] / k)
+        radius[i] = radius[i] * beta / (1 - beta) * (1 - delta) / delta
+        r[i] = radius[i]
+        iterations += 1
+        for j in [i] + [j for j in set(fan) if solved[j]]:
+            residual[j] = _theta_arround(radius, j, fans[j]) - total[j]
+            if abs(residual[j]) > eps and not queued[j]:
+                heapq.heappush(queue, (-abs(residual[j]), j))
+                queued[j] = True
+    norm = np.max(np.abs(np.array(residual)[index]), initial=0)
+    if not norm <= eps and status == 'converged':
+        status = 'diverged'
+    return iterations, float(norm), status
 
 
 def _anchor_x_y(cb, origin_index_cb):
@@ -858,79 +1350,98 @@ def _anchor_x_y(cb, origin_index_cb):
     return anchor_x, anchor_y
 
 
-def _layout_circles(faces, anchor_x, anchor_y, origin):
+def _layout_order(faces, placed):
     """
-    Lay out circles. First place the circle on the origin of the cooridinate and the circles in anchor_x 
-    and anchor_y. After these circles are placed, the rest circles would be placed forcedly by the connectivity
-    relationship encoded in faces.
+    The order in which _layout_circles places the circles. Starting from the placed
+    circles, the first face with exactly two placed circles places its third one,
+    again and again until every face is done. This only depends on the topology, so
+    _Packing works it out once instead of searching the faces on every layout.
+
     # Arguments:
-        faces: list of Faces
-        anchor_x: list of _CircleVertex, the circles lying along x axis
-        anchor_y: list of _CircleVertex, the circles lying along y axis
-        origin: _CircleVertex, the cirlce lying on origin of coordinate
+        faces: (n_faces, 3) int array, the circles of every face
+        placed: int array, the circles placed first (the anchors)
+
+    # Returns:
+        layout: (n_placed, 3) int array, (i, j, k): circle k is placed next to i and j,
+            in the order of the face
     """
-    x_coord = 0
-    anchor_x[0].x = 0
-    anchor_x[0].y = 0
-    anchor_x[0].placed = 1
-    for i in range(1, len(anchor_x)):
-        x_coord += anchor_x[i - 1].radius + anchor_x[i].radius
-        anchor_x[i].x = x_coord
-        anchor_x[i].y = 0
-        anchor_x[i].placed = 1
-    # layout anchers along y
-    y_coord = 0
-    y_coord += origin.radius + anchor_y[0].radius
-    anchor_y[0].y = y_coord
-    anchor_y[0].x = 0
-    anchor_y[0].placed = 1
-    for i in range(1, len(anchor_y)):
-        y_coord += anchor_y[i - 1].radius + anchor_y[i].radius
-        anchor_y[i].y = y_coord
-        anchor_y[i].x = 0
-        anchor_y[i].placed = 1
-    # layour other circles
-    faces_copy = faces.copy()
+    is_placed = [0] * (np.max(faces) + 1)
+    for i in placed.tolist():
+        is_placed[i] = 1
+    faces_copy = faces.tolist()
+    layout = []
     i_face = 0
     while faces_copy != []:
-        # TODO - This can be improved
-        if 3 == faces_copy[i_face].vertex1.placed + faces_copy[i_face].vertex2.placed + faces_copy[i_face].vertex3.placed:
+        v1, v2, v3 = faces_copy[i_face]
+        n_placed = is_placed[v1] + is_placed[v2] + is_placed[v3]
+        if n_placed == 3:
             faces_copy.pop(i_face)
             i_face = 0
-        elif faces_copy[i_face].vertex1.placed + faces_copy[i_face].vertex2.placed + faces_copy[i_face].vertex3.placed == 2:
-            if faces_copy[i_face].vertex1.placed == 1 and faces_copy[i_face].vertex2.placed == 1:
-                vi = faces_copy[i_face].vertex1
-                vj = faces_copy[i_face].vertex2
-                vk = faces_copy[i_face].vertex3
-            elif faces_copy[i_face].vertex2.placed == 1 and faces_copy[i_face].vertex3.placed == 1:
-                vi = faces_copy[i_face].vertex2
-                vj = faces_copy[i_face].vertex3
-                vk = faces_copy[i_face].vertex1
+        elif n_placed == 2:
+            if is_placed[v1] and is_placed[v2]:
+                layout.append((v1, v2, v3))
+            elif is_placed[v2] and is_placed[v3]:
+                layout.append((v2, v3, v1))
             else:
-                vi = faces_copy[i_face].vertex3
-                vj = faces_copy[i_face].vertex1
-                vk = faces_copy[i_face].vertex2
-            theta_ij = atan2(vj.y - vi.y, vj.x - vi.x)
-            ri = vi.radius
-            rj = vj.radius
-            rk = vk.radius
-            alpha_i = acos(((ri + rj)**2 + (ri + rk)**2 - (rj + rk)**2) /
-                                (2 * (ri + rj) * (ri + rk)))
-            vk.x = vi.x + (ri + rk) * cos(alpha_i + theta_ij)
-            vk.y = vi.y + (ri + rk) * sin(alpha_i + theta_ij)
-            vk.placed = 1
+                layout.append((v3, v1, v2))
+            is_placed[layout[-1][2]] = 1
             faces_copy.pop(i_face)
             i_face = 0
         else:
             i_face = i_face + 1
             if i_face == len(faces_copy):
                 i_face = 0
+    return np.array(layout, dtype=int).reshape(-1, 3)
 
-def _draw_circles(circles, l):
+
+def _layout_circles(packing):
+    """
+    Lay out circles. First place the circle on the origin of the cooridinate and the circles in anchor_x 
+    and anchor_y. After these circles are placed, the rest circles would be placed forcedly by the connectivity
+    relationship encoded in the faces, in the order of packing.layout.
+    # Arguments:
+        packing: _Packing, the circle packing, its xy is updated in place
+    """
+    r = packing.radius.tolist()
+    x = packing.xy[:, 0].tolist()
+    y = packing.xy[:, 1].tolist()
+    anchor_x = packing.anchor_x.tolist()
+    anchor_y = packing.anchor_y.tolist()
+    x_coord = 0
+    x[anchor_x[0]] = 0
+    y[anchor_x[0]] = 0
+    for i in range(1, len(anchor_x)):
+        x_coord += r[anchor_x[i - 1]] + r[anchor_x[i]]
+        x[anchor_x[i]] = x_coord
+        y[anchor_x[i]] = 0
+    # layout anchers along y
+    y_coord = 0
+    y_coord += r[packing.origin] + r[anchor_y[0]]
+    y[anchor_y[0]] = y_coord
+    x[anchor_y[0]] = 0
+    for i in range(1, len(anchor_y)):
+        y_coord += r[anchor_y[i - 1]] + r[anchor_y[i]]
+        y[anchor_y[i]] = y_coord
+        x[anchor_y[i]] = 0
+    # layour other circles
+    for i, j, k in packing.layout.tolist():
+        theta_ij = atan2(y[j] - y[i], x[j] - x[i])
+        ri = r[i]
+        rj = r[j]
+        rk = r[k]
+        alpha_i = acos(((ri + rj)**2 + (ri + rk)**2 - (rj + rk)**2) /
+                            (2 * (ri + rj) * (ri + rk)))
+        x[k] = x[i] + (ri + rk) * cos(alpha_i + theta_ij)
+        y[k] = y[i] + (ri + rk) * sin(alpha_i + theta_ij)
+    packing.xy[:, 0] = x
+    packing.xy[:, 1] = y
+
+
+def _draw_circles(packing, l):
     """ 
     Plot circles with their position and the position of their centers
     # Arguments:
-        circles: list of _CircleVertex
+        packing: _Packing, the circle packing
         l: float, the half length of bridge
     """
     fig, ax = plt.subplots()
@@ -938,14 +1449,15 @@ def _draw_circles(circles, l):
     ax.set_xlim((0, l))
     ax.set_ylim((0, l))
 
-    for c in circles:
-        #ax.add_artist(plt.Circle((c.x, c.y), c.radius, color='g'))
-        ax.add_artist(plt.Circle((c.x, c.y),
-                      c.radius,
+    for (x, y), radius in zip(packing.xy, packing.radius):
+        #ax.add_artist(plt.Circle((x, y), radius, color='g'))
+        ax.add_artist(plt.Circle((x, y),
+                      radius,
                       edgecolor='r',
                       fill=False))
     plt.show()
 
+
 def _draw_bridge(points, length=CONFIG['length'], height=CONFIG['height']):
     """
     points = array_like, shape (n,2)
@@ -955,7 +1467,7 @@ def _draw_bridge(points, length=CONFIG['length'], height=CONFIG['height']):
         plt.plot(points[i:i+2,0], points[i:i+2,1], 'ro-')
     plt.show()
 
-def _generate_circlepacking(tri, delta, eps, delta_r):
+def _generate_circlepacking(tri, delta, eps, delta_r, method='fixed_step'):
     """
     generate a circlepacking whose complex K is same as the connectivity relation
     of tri
@@ -967,16 +1479,11 @@ def _generate_circlepacking(tri, delta, eps, delta_r):
         delta: the distance of the discrete points in the domain
         eps: Float, error tolerate for circle packing calculation
         delta_r, Float, the changes of radii in each iteration in the process of calculation
+        method: str, how the radii are calculated, 'newton', 'fixed_step' or 'local'
+            (see _calculate_radii)
 
     # Returns:
-    LD: List of _CircleVertex, list of leading dancers
-    AD: List of _CircleVertex, list of accompanying dancers
-    circles: List of _CircleVertex, list of all circles
-    faces: List of _Face
-    cb: List of _CircleVertex, list of boundary circles
-    anchor_x: List of _CircleVertex, list of the circles lying along x axis
-    anchor_y: List of _CircleVertex, list of the circles lying along y axis
-    origin: _CircleVertex, the circle lying on the origin (0,0)
+    packing: _Packing, the radii, the centers and the topology of the circles
     """
     # the circles of the packing
     circles = []
@@ -1011,126 +1518,185 @@ def _generate_circlepacking(tri, delta, eps, delta_r):
         cb, tri.points)
     # collect the leading dancers (the circles we can manipulate their radii)
     LD = _leanding_dancers(cb, ld_start_index, ld_end_index)
-    # collect the accompanying dancers (the rest of the circles)
-    AD = []
-    for c in circles:
-        if _in_circles(c, LD) == False:
-            AD.append(c)
     # determine the surround angle for leading dancers
     _calculate_ld_surround_angles(LD)
-    # Calculate radii for circles
-    _calculate_radii(circles, eps, delta_r, LD[1])
-    # Layout circles
     # anchers lie along x axis
     anchor_x, anchor_y = _anchor_x_y(cb, origin_index_cb)
-    # layout anchers along x
-    _layout_circles(faces, anchor_x, anchor_y, origin)
-    # unplace circles
-    for i in range(len(circles)):
-        circles[i].placed = 0
-    # adjust radii and unplace circles
+    # from here on the packing is kept in arrays, leading dancers numbered first
+    packing = _Packing(circles, faces, cb, LD, ci, anchor_x, anchor_y, origin)
+    # Calculate radii for circles, leaving out LD[1]
+    _calculate_radii(packing, slice(None), eps, delta_r, leavingout=1, method=method)
+    # Layout circles
+    _layout_circles(packing)
+    # adjust radii
     x_max = max(tri.points[:, 0])
-    adjust_ratio = x_max / LD[0].x
-    for c in circles:
-        c.x = c.x * adjust_ratio
-        c.y = c.y * adjust_ratio
-        c.radius = c.radius * adjust_ratio
-    # output radii of LD, boundary and all circles
-    rld = [0] * len(LD)
-    for i in range(len(LD)):
-        rld[i] = LD[i].radius
-    # collect accomany boundary dancers
-    AccB = []
-    for i in range(len(cb) - 1):  # cb[0] == cb[-1]
-        if _in_circles(cb[i], LD) == False:
-            AccB.append(cb[i])
-    raccb = [0] * len(AccB)
-    for i in range(len(AccB)):
-        raccb[i] = AccB[i].radius
-    ri = [0] * len(ci)
-    for i in range(len(ci)):
-        ri[i] = ci[i].radius
-    r = [0] * len(circles)
-    for i in range(len(circles)):
-        r[i] = circles[i].radius
-
-    return rld, raccb, ri, r, LD, AccB, ci, AD, circles, faces, cb, anchor_x, anchor_y, origin
+    adjust_ratio = x_max / packing.xy[0, 0]
+    packing.xy *= adjust_ratio
+    packing.radius *= adjust_ratio
+    return packing
 
 
-def _modify_circlepacking(rld_new, raccb, ri, r, LD, AccB, ci, AD, circles, eps,
-                          delta_r):
+def _modify_circlepacking(rld_new, packing, eps, delta_r, method='newton',
+                          max_iterations=None, time_budget=None, patience=None):
     """
     Add modification to the radii of leading dancers, then calculate
     the radii of accompanying dancers
 
     # Arguments:
 
-        dr: list of float, the changes added to radii of leading dancers
-        LD: list of _CircleVertex, the list of leading dancers
-        AD: list of _CircleVertex, the list of accompanying dancers
+        rld_new: list of float, the new radii of leading dancers
+        packing: _Packing, the circle packing, updated in place
+        eps: float, error tolerate
+        delta_r: float, the magnitude of radii change in each iteration
+        method: str, 'newton', 'fixed_step' or 'local' (see _calculate_radii)
+        max_iterations, time_budget, patience: the budgets of the solve, see
+            _calculate_radii
+
+    # Returns:
+        iterations, residual, status: see _calculate_radii
     """
-    for i in range(len(LD)):  # add the changes
-        LD[i].radius = rld_new[i]
-    _calculate_radii(AD, eps, delta_r)
-    # output radii of all circles
-    for i in range(len(AccB)):
-        raccb[i] = AccB[i].radius
-    for i in range(len(ci)):
-        ri[i] = ci[i].radius
-    for i in range(len(circles)):
-        r[i] = circles[i].radius
+    packing.radius[packing.ld] = rld_new
+    return _calculate_radii(packing, packing.ad, eps, delta_r, method=method,
+                            max_iterations=max_iterations, time_budget=time_budget,
+                            patience=patience)
 
 
-def _generate_boundary_edges(LD, circles, faces, anchor_x, anchor_y, origin):
+def _generate_boundary_edges(packing):
     """
     layout the circlepacking, determine the coordintes for every circle, then
     get the coordinates of the points on boundary edges
 
     # Arguments:
-        LD: List of _CircleVertex, collection of leading dancers
-        AD: List of _CircleVertex, collection of accompanying dancers
-        circles: List of _CircleVertex, collection of all circles
-        faces: List of _Face
-        cb: List of _CircleVertex, collection of boundary circles
-        anchor_x: List of _CircleVertex, collection of the circles lying along x axis
-        anchor_y: List of _CircleVertex, collection of the circles lying along y axis
-        origin: _CircleVertex, the circle lying on the origin (0,0)
+        packing: _Packing, the circle packing, laid out in place
 
     # Returns:
-        boundary_edges: nx5 Arrary, n is the length of LD
-        r_ld: list of float, the collection of radii of leading dancers
-        r: list of float, the collection of all circles
+        boundary_edges: nx5 Arrary, n is the number of leading dancers minus one
 
     """
-    # Layout circles
-    _layout_circles(faces, anchor_x, anchor_y, origin)
-    # unplace circles
-    for i in range(len(circles)):
-        circles[i].placed = 0
-    # output coordinate of LD
-    boundary_edges = np.ones((len(LD) - 1, 5))
-    for i in range(len(LD) - 1):
-        boundary_edges[i][1] = LD[i].x
-        boundary_edges[i][2] = LD[i].y
-        boundary_edges[i][3] = LD[i + 1].x
-        boundary_edges[i][4] = LD[i + 1].y
+    boundary_edges = np.ones((packing.n_ld - 1, 5))
+    _modify_boundary_edges(boundary_edges, packing)
     return boundary_edges
 
 
-def _modify_boundary_edges(boundary_edges, LD, circles, faces, anchor_x,
-                           anchor_y, origin):
+def _modify_boundary_edges(boundary_edges, packing):
     """
     layout the circlepacking, determine the coordintes for every circle, then
     get the coordinates of the points on boundary edges
     """
     # Layout circles
-    _layout_circles(faces, anchor_x, anchor_y, origin)
-    # unplace circles
-    for i in range(len(circles)):
-        circles[i].placed = 0
+    _layout_circles(packing)
     # output coordinate of LD
-    for i in range(len(LD) - 1):
-        boundary_edges[i][1] = LD[i].x
-        boundary_edges[i][2] = LD[i].y
-        boundary_edges[i][3] = LD[i + 1].x
-        boundary_edges[i][4] = LD[i + 1].y
+    xy = packing.xy[packing.ld]
+    boundary_edges[:, 1:3] = xy[:-1]
+    boundary_edges[:, 3:5] = xy[1:]
+
+
+def _corner_angles(ri, rj, rk):
+    """
+    The angle at circle i of the triangle of three mutually tangent circles i, j, k
+    (the terms of _theta_arround) and its partial derivatives.
+
+    # Arguments:
+        ri, rj, rk: float arrays, the radii
+
+    # Returns:
+        alpha: float array, the angles
+        dalpha_ri, dalpha_rj, dalpha_rk: float arrays, the partial derivatives
+    """
+    a = ri + rj
+    b = ri + rk
+    c = rj + rk
+    C = (a**2 + b**2 - c**2) / (2 * a * b)
+    alpha = np.arccos(C)
+    # dalpha = -dC / sin(alpha), with C a function of the side lengths a, b and c
+    ds = -1 / np.sin(alpha)
+    dC_a = (a**2 - b**2 + c**2) / (2 * a**2 * b)
+    dC_b = (b**2 - a**2 + c**2) / (2 * a * b**2)
+    dC_c = -c / (a * b)
+    return alpha, ds * (dC_a + dC_b), ds * (dC_a + dC_c), ds * (dC_b + dC_c)
+
+
+def _get_grad_radii(packing):
+    """
+    The derivative of the radii of all circles with respect to the radii of the leading
+    dancers. _calculate_radii sets the radii of the accompanying dancers so that their
+    surround angles theta keep their prescribed values, so by the implicit function
+    theorem dr_AD/dr_LD = -(dtheta_AD/dr_AD)^-1 dtheta_AD/dr_LD.
+
+    # Arguments:
+        packing: _Packing, the circle packing
+
+    # Returns:
+        dr: (n, n_ld) float array, dr[c, i] is the derivative of the radius of circle c
+            with respect to the radius of leading dancer i
+    """
+    # the triangles (i, j, k) around every accompanying dancer, see _theta_arround
+    corners = np.flatnonzero(packing.corners[:, 0] >= packing.n_ld)
+    J = _angle_jacobian(packing, corners)[packing.ad].toarray()
+    ld, ad = packing.ld, packing.ad
+    dr = np.zeros((len(packing.radius), packing.n_ld))
+    dr[ld] = np.eye(packing.n_ld)
+    dr[ad] = -np.linalg.solve(J[:, ad], J[:, ld])
+    return dr
+
+
+def _layout_tangents(packing, dr):
+    """
+    Forward mode derivative of _layout_circles: replay the order in which the circles
+    get placed and carry the derivatives of their centers along. The circles must have
+    been laid out for their current radii.
+
+    # Arguments:
+        packing: _Packing, the circle packing
+        dr: (n, m) float array, the derivatives of the radii with respect to m
+            parameters
+
+    # Returns:
+        dx, dy: (n, m) float arrays, the derivatives of the centers
+    """
+    dx = np.zeros(dr.shape)
+    dy = np.zeros(dr.shape)
+    anchor_x, anchor_y = packing.anchor_x, packing.anchor_y
+    for i in range(1, len(anchor_x)):
+        dx[anchor_x[i]] = dx[anchor_x[i - 1]] + dr[anchor_x[i - 1]] + dr[anchor_x[i]]
+    dy[anchor_y[0]] = dr[packing.origin] + dr[anchor_y[0]]
+    for i in range(1, len(anchor_y)):
+        dy[anchor_y[i]] = dy[anchor_y[i - 1]] + dr[anchor_y[i - 1]] + dr[anchor_y[i]]
+    r = packing.radius.tolist()
+    x = packing.xy[:, 0].tolist()
+    y = packing.xy[:, 1].tolist()
+    for i, j, k in packing.layout.tolist():
+        Lx = x[j] - x[i]
+        Ly = y[j] - y[i]
+        theta_ij = atan2(Ly, Lx)
+        dtheta_ij = (Lx * (dy[j] - dy[i]) - Ly * (dx[j] - dx[i])) / (Lx**2 + Ly**2)
+        alpha_i, d_ri, d_rj, d_rk = _corner_angles(r[i], r[j], r[k])
+        dphi = d_ri * dr[i] + d_rj * dr[j] + d_rk * dr[k] + dtheta_ij
+        phi = alpha_i + theta_ij
+        length = r[i] + r[k]
+        dx[k] = dx[i] + (dr[i] + dr[k]) * cos(phi) - length * sin(phi) * dphi
+        dy[k] = dy[i] + (dr[i] + dr[k]) * sin(phi) + length * cos(phi) * dphi
+    return dx, dy
+
+
+def _get_grad_edges(packing):
+    """
+    The derivative of the boundary edges (see _generate_boundary_edges) with respect to
+    the radii of the leading dancers, through the radii of the accompanying dancers
+    (_get_grad_radii) and the layout (_layout_tangents).
+
+    # Returns:
+        gedges: (n_ld - 1, 5, n_ld) float array, gedges[i, k, j] is the derivative
+            of boundary_edges[i][k] with respect to the radius of leading dancer j
+    """
+    dr = _get_grad_radii(packing)
+    dx, dy = _layout_tangents(packing, dr)
+    ld = np.arange(packing.n_ld)
+    gedges = np.zeros((packing.n_ld - 1, 5, packing.n_ld))
+    gedges[:, 1] = dx[ld[:-1]]
+    gedges[:, 2] = dy[ld[:-1]]
+    gedges[:, 3] = dx[ld[1:]]
+    gedges[:, 4] = dy[ld[1:]]
+    return gedges
+
+
@@ -0,0 +1,735 @@
+"""tests_FEM.py"""
+
+import unittest
+from unittest import mock
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import cg, splu
+from matplotlib.path import Path
+from _FEM import _FEM, _rasterize, _membershiptest, distance_point_boundary, _ccw, ay, \
+    _get_mesh, KE, Emin, E0, _SolverState, _FEM_batch, p_norm, _LOADS, _compliance, \
+    _compliance_gradient, _solve_direct, _rasterize_gradient, _FEMCache, \
+    _work_bound, _rasterize_update, _rasterize_coverage, _rasterize_coverage_gradient, \
+    _rescale
+import _FEM as _FEM_module
+
+# Boundary edges of the initial BridgeHoleDesign hole, rounded.
+EDGES = np.array([[1., 15.772, 0., 15.7695, 1.7389],
+                  [1., 15.7695, 1.7389, 14.7508, 2.7467],
+                  [1., 14.7508, 2.7467, 13.5589, 3.9229],
+                  [1., 13.5589, 3.9229, 11.8514, 5.5983],
+                  [1., 11.8514, 5.5983, 8.7381, 7.1212],
+                  [1., 8.7381, 7.1212, 4.9089, 7.8644],
+                  [1., 4.9089, 7.8644, 2.5373, 7.8413],
+                  [1., 2.5373, 7.8413, 1.2151, 7.8361],
+                  [1., 1.2151, 7.8361, 0., 7.835]])
+
+# EDGES with noise 0.2*i*randn on the coordinates of NOISY_EDGES[i]. The noisier holes
+# leave solid islands held only by void elements (6 or 7 solid components for 1, 2
+# and 4), on which the reduced stiffness matrix is extremely ill-conditioned.
+_rng = np.random.RandomState(1)
+NOISY_EDGES = [np.column_stack((EDGES[:, :1], EDGES[:, 1:] + 0.2*i*_rng.randn(len(EDGES), 4)))
+               for i in range(5)]
+
+
+def _rasterize_loop(Edges, nely, nelx):
+    """The per-element rasterization _FEM used to do, kept as a reference."""
+    x = np.zeros([nely, nelx])
+    inside = np.zeros([nely, nelx], dtype=bool)
+    ccw_cda = np.ones(len(Edges))
+    for i in range(0, len(Edges)):
+        ccw_cda[i] = _ccw(Edges[i][1], Edges[i][2], Edges[i][3], Edges[i][4], 0, ay)
+    for ely in range(nely):
+        for elx in range(nelx):
+            if _membershiptest((elx+1), (nely-ely-1), Edges, nely, nelx, ccw_cda) == False:
+                r = distance_point_boundary((elx+1), (nely-ely-1), Edges)
+                x[ely][elx] = max(0, min(r, 1.0))
+            else:
+                inside[ely][elx] = True
+    return x, inside
+
+
+class RasterizeTest(unittest.TestCase):
+    def test_rasterize_matches_loop(self):
+        """The vectorized rasterization matches the per-element loop: the same hole
+        membership, and densities within a few ulp (the squares round differently)."""
+        rng = np.random.RandomState(0)
+        for ii in range(10):
+            edges = EDGES.copy()
+            edges[:, 1:] += 0.2 * ii * rng.randn(*edges[:, 1:].shape)
+            for nely, nelx in [(10, 20), (7, 13)]:
+                x, inside = _rasterize(edges, nely, nelx)
+                x_loop, inside_loop = _rasterize_loop(edges, nely, nelx)
+                np.testing.assert_array_equal(inside, inside_loop)
+                np.testing.assert_array_max_ulp(x, x_loop, maxulp=4)
+
+    def test_rasterize_update(self):
+        """Redoing the work of the moved edges only is bit-identical to rasterizing from
+        scratch."""
+        rng = np.random.RandomState(0)
+        vertices = np.concatenate((EDGES[:, 1:3], EDGES[-1:, 3:5]))
+        for nely, nelx in [(10, 20), (20, 40)]:
+            edges_old = EDGES
+            x_old, inside_old = _rasterize(edges_old, nely, nelx)
+            for ii in range(10):
+                # move a few vertices, keeping the ends on the axes
+                v = vertices.copy()
+                moved = rng.choice(len(v), 2, replace=False)
+                v[moved] += 0.3 * rng.randn(2, 2)
+                v[0, 1] = v[-1, 0] = 0
+                edges = np.column_stack((np.ones(len(EDGES)), v[:-1], v[1:]))
+                x, inside, n = _rasterize_update(edges, nely, nelx, edges_old, x_old, inside_old)
+                x_full, inside_full = _rasterize(edges, nely, nelx)
+                np.testing.assert_array_equal(inside, inside_full)
+                np.testing.assert_array_equal(x, x_full)
+                self.assertLess(n, nely*nelx)
+                edges_old, x_old, inside_old = edges, x, inside
+        # any edges, not only chains closing the hole
+        edges = edges_old.copy()
+        edges[3, 1:] += 0.3
+        x, inside, n = _rasterize_update(edges, 20, 40, edges_old, x_old, inside_old)
+        np.testing.assert_array_equal(x, _rasterize(edges, 20, 40)[0])
+        np.testing.assert_array_equal(inside, _rasterize(edges, 20, 40)[1])
+
+    def test_rasterize_coverage(self):
+        """The coverage densities match counting sub-cell points in the hole polygon, and
+        the hole area."""
+        for nely, nelx in [(10, 20), (7, 13)]:
+            x, inside = _rasterize_coverage(EDGES, nely, nelx)
+            corners = np.concatenate(([[0, 0]], EDGES[:, 1:3], EDGES[-1:, 3:5])) * \
+                [0.05*nelx, 0.1*nely]
+            polygon = Path(corners)
+            s = (np.arange(32) + 0.5) / 32
+            ely, elx = np.mgrid[0:nely, 0:nelx]
+            px = (elx[..., None, None] + s[None, None, None, :]).repeat(32, axis=2)
+            py = (nely - ely - 1)[..., None, None] + s[None, None, :, None] + 0 * px
+            covered = polygon.contains_points(np.column_stack((px.ravel(), py.ravel())))
+            x_count = 1 - covered.reshape(nely, nelx, -1).mean(axis=-1)
+            np.testing.assert_allclose(x, x_count, atol=0.02)
+            next_corners = np.roll(corners, -1, axis=0)
+            area = 0.5 * np.sum(corners[:, 0] * next_corners[:, 1] -
+                                next_corners[:, 0] * corners[:, 1])
+            self.assertAlmostEqual(np.sum(1 - x), area)
+            np.testing.assert_array_equal(inside, x == 0)
+        sigma, area = _FEM(EDGES, 10, 20, False, density='coverage')
+        self.assertAlmostEqual(area, np.sum(1 - _rasterize_coverage(EDGES, 10, 20)[0]))
+
+    def test_FEM_area_counts_hole_elements(self):
+        x, inside = _rasterize(EDGES, 10, 20)
+        sigma, area = _FEM(EDGES, 10, 20, False)
+        self.assertEqual(area, np.count_nonzero(inside))
+        self.assertTrue(np.all(x[inside] == 0))
+        self.assertGreater(sigma, 0)
+
+
+class MeshTest(unittest.TestCase):
+    def test_get_mesh_is_cached(self):
+        self.assertIs(_get_mesh(10, 20), _get_mesh(10, 20))
+        self.assertIsNot(_get_mesh(10, 20), _get_mesh(5, 10))
+
+    def test_assemble_matches_coo(self):
+        """Scattering into the fixed CSR pattern gives the coo_matrix assembly."""
+        nely, nelx = 7, 13
+        mesh = _get_mesh(nely, nelx)
+        x = np.random.rand(nely, nelx)
+        E = Emin + np.power(x.T.reshape(-1), 3) * (E0 - Emin)
+        sK = np.outer(E, KE.T.reshape(-1)).reshape(-1)
+        K_mesh = mesh.assemble(x).toarray()
+        K = coo_matrix((sK, (mesh.iK, mesh.jK)), shape=(mesh.ndof, mesh.ndof)).toarray()
+        np.testing.assert_allclose(K_mesh, K, rtol=1e-12, atol=1e-3)
+
+    def test_operator_matches_assemble(self):
+        """The matrix free operator applies the assembled reduced matrix, stacks included."""
+        mesh = _get_mesh(7, 13)
+        x = np.random.rand(3, 7, 13)
+        K2 = mesh.assemble_free(x)
+        operator = mesh.operator(x)
+        self.assertEqual(operator.shape, K2.shape)
+        v = np.random.rand(K2.shape[0])
+        np.testing.assert_allclose(operator @ v, K2 @ v, rtol=1e-12, atol=1e-3)
+        np.testing.assert_allclose(operator.diagonal(), K2.diagonal())
+
+    def test_operator_skips_assembly_tables(self):
+        """A matrix free solve builds only the topology of the mesh."""
+        with mock.patch.dict(_FEM_module._MESHES, clear=True):
+            sigma, area = _FEM(EDGES, 10, 20, False, solver='mfcg')
+            mesh = _get_mesh(10, 20)
+            self.assertIsNone(mesh.indices)
+            self.assertIsNone(mesh.free_scatter)
+            self.assertAlmostEqual(sigma / _FEM(EDGES, 10, 20, False, solver='banded')[0],
+                                   1.0, places=4)
+            self.assertIsNotNone(mesh.indices)
+
+    def test_patch_free(self):
+        """Patching the changed elements gives the freshly assembled matrix bit for bit,
+        void included."""
+        nely, nelx = 7, 13
+        mesh = _get_mesh(nely, nelx)
+        rng = np.random.RandomState(2)
+        x_old = rng.rand(nely, nelx)
+        K2 = mesh.assemble_free(x_old)
+        for ii in range(10):
+            x = x_old.copy()
+            x.flat[rng.randint(0, nely*nelx, 4)] = rng.choice([0.0, 1.0, 0.5], 4)
+            changed = mesh.patch_free(K2, x_old, x)
+            self.assertEqual(changed, np.count_nonzero(x != x_old))
+            np.testing.assert_array_equal(K2.data, mesh.assemble_free(x).data)
+            x_old = x
+
+    def test_FEM_regression(self):
+        sigma, area = _FEM(EDGES, 10, 20, False)
+        self.assertEqual(area, 103)
+        self.assertAlmostEqual(sigma / 2.3278703469218556e-05, 1.0, places=3)
+
+
+class PostProcessTest(unittest.TestCase):
+    def test_full_output(self):
+        sigma, area, info = _FEM(EDGES, 10, 20, False, solver='direct', full_output=True)
+        mesh = _get_mesh(10, 20)
+        self.assertEqual(info['strain_energy'].shape, (10, 20))
+        self.assertEqual(info['von_mises'].shape, (10, 20))
+        # twice the strain energy is the work of the load
+        F_U = mesh.F[:, 0] @ info['U']
+        self.assertAlmostEqual(2 * info['strain_energy'].sum() / F_U, 1.0, places=8)
+        self.assertTrue(np.all(info['von_mises'] >= 0))
+        self.assertEqual(info['von_mises_max'], info['von_mises'].max())
+        self.assertLessEqual(info['von_mises_max'], info['von_mises_pnorm'])
+        self.assertLessEqual(info['von_mises_pnorm'],
+                             info['von_mises_max'] * (10 * 20) ** (1 / p_norm))
+        self.assertTrue(np.all(info['von_mises'][info['x'] == 0] < 1e-6))
+
+
+class LoadCaseTest(unittest.TestCase):
+    def test_load_cases_match_single_solves(self):
+        """All load cases solved together give the compliance of every case on its own."""
+        loads = ['uniform', 'point', 'lane', 'self_weight']
+        for solver in ['direct', 'banded', 'pcg', 'woodbury']:
+            compliance, area, info = _FEM(EDGES, 10, 20, False, solver, _SolverState(),
+                                          True, loads)
+            self.assertEqual(compliance.shape, (4,))
+            self.assertEqual(info['von_mises'].shape, (4, 10, 20))
+            self.assertEqual(info['von_mises_max'].shape, (4,))
+            for k, load in enumerate(loads):
+                sigma, area_k = _FEM(EDGES, 10, 20, False, 'direct', loads=[load])
+                self.assertEqual(area, area_k)
+                self.assertAlmostEqual(compliance[k] / sigma[0], 1.0, places=4)
+
+    def test_uniform_is_the_default(self):
+        sigma, area = _FEM(EDGES, 10, 20, False, 'direct')
+        sigma_cases, area_cases = _FEM(EDGES, 10, 20, False, 'direct', loads=['uniform'])
+        self.assertEqual(sigma, sigma_cases[0])
+
+    def test_load_totals(self):
+        mesh = _get_mesh(10, 20)
+        x = np.ones((10, 20))
+        self.assertAlmostEqual(_LOADS['point'](mesh, x).sum(), -0.5 * 10**7)
+        self.assertAlmostEqual(_LOADS['self_weight'](mesh, x).sum(), -10**7)
+        self.assertAlmostEqual(_LOADS['self_weight'](mesh, 0.5 * x).sum(), -0.5 * 10**7)
+        lane = _LOADS['lane'](mesh, x)
+        self.assertTrue(np.all(lane[:2*11*10] == 0))
+        self.assertLess(lane.sum(), 0)
+
+
+class GradientTest(unittest.TestCase):
+    def sigma(self, mesh, x, loads):
+        K2 = mesh.assemble_free(x)
+        F = np.stack([_LOADS[load](mesh, x) for load in loads], axis=1)
+        U = np.zeros(F.shape)
+        U[mesh.freedofs] = _solve_direct(K2, F[mesh.freedofs])
+        return _compliance(mesh, x, U.T), U.T, K2
+
+    def test_compliance_gradient(self):
+        """The adjoint gradient matches central differences, self weight included."""
+        mesh = _get_mesh(10, 20)
+        x = np.clip(_rasterize(EDGES, 10, 20)[0] + 0.3 * np.random.RandomState(4).rand(10, 20),
+                    0.05, 1)
+        loads = ['uniform', 'self_weight']
+        sigma, U, K2 = self.sigma(mesh, x, loads)
+        gradient = _compliance_gradient(mesh, x, U, lambda G2: _solve_direct(K2, G2), loads)
+        self.assertEqual(gradient.shape, (2, 10, 20))
+        h = 1e-6
+        for ely, elx in [(0, 0), (3, 5), (5, 10), (9, 19)]:
+            xp, xm = x.copy(), x.copy()
+            xp[ely, elx] += h
+            xm[ely, elx] -= h
+            fd = (self.sigma(mesh, xp, loads)[0] - self.sigma(mesh, xm, loads)[0]) / (2 * h)
+            np.testing.assert_allclose(gradient[:, ely, elx], fd, rtol=1e-5)
+
+    def test_rasterize_gradient(self):
+        """Moving a vertex of the hole moves the boundary densities as predicted."""
+        vertices = np.concatenate((EDGES[:, 1:3], EDGES[-1:, 3:5]))
+        edges = lambda v: np.concatenate((np.ones((len(v) - 1, 1)), v[:-1], v[1:]), axis=1)
+        dx = _rasterize_gradient(EDGES, 10, 20)
+        # a vertex is the end of one edge and the start of the next
+        dv = np.zeros((10, 20, len(vertices), 2))
+        dv[:, :, :-1] += dx[:, :, :, 1:3]
+        dv[:, :, 1:] += dx[:, :, :, 3:5]
+        h = 1e-6
+        for i in range(len(vertices)):
+            for k in range(2):
+                vp, vm = vertices.copy(), vertices.copy()
+                vp[i, k] += h
+                vm[i, k] -= h
+                (xp, inside_p), (xm, inside_m) = _rasterize(edges(vp), 10, 20), _rasterize(edges(vm), 10, 20)
+                same = inside_p == inside_m
+                np.testing.assert_allclose(((xp - xm) / (2 * h))[same], dv[:, :, i, k][same],
+                                           atol=1e-6)
+
+    def test_rasterize_coverage_gradient(self):
+        """Moving a vertex of the hole changes the coverage densities as predicted. The
+        end points leaving their axis are one sided (the hole then reaches outside the
+        domain) and left out."""
+        vertices = np.concatenate((EDGES[:, 1:3], EDGES[-1:, 3:5]))
+        edges = lambda v: np.concatenate((np.ones((len(v) - 1, 1)), v[:-1], v[1:]), axis=1)
+        dx = _rasterize_coverage_gradient(EDGES, 10, 20)
+        dv = np.zeros((10, 20, len(vertices), 2))
+        dv[:, :, :-1] += dx[:, :, :, 1:3]
+        dv[:, :, 1:] += dx[:, :, :, 3:5]
+        h = 1e-6
+        for i in range(len(vertices)):
+            for k in range(2):
+                if (i, k) in [(0, 1), (len(vertices) - 1, 0)]:
+                    continue
+                vp, vm = vertices.copy(), vertices.copy()
+                vp[i, k] += h
+                vm[i, k] -= h
+                fd = (_rasterize_coverage(edges(vp), 10, 20)[0] -
+                      _rasterize_coverage(edges(vm), 10, 20)[0]) / (2 * h)
+                np.testing.assert_allclose(fd, dv[:, :, i, k], atol=1e-6)
+
+    def test_FEM_coverage_gradient(self):
+        """With coverage densities sigma is smooth in the vertices and its gradient
+        matches central differences of the whole analysis."""
+        vertices = np.concatenate((EDGES[:, 1:3], EDGES[-1:, 3:5]))
+        edges = lambda v: np.concatenate((np.ones((len(v) - 1, 1)), v[:-1], v[1:]), axis=1)
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'direct', full_output=True,
+                                 gradient=True, density='coverage')
+        g = info['gsigma_edges']
+        h = 1e-5
+        for i, k in [(0, 0), (3, 0), (4, 1), (6, 1)]:
+            vp, vm = vertices.copy(), vertices.copy()
+            vp[i, k] += h
+            vm[i, k] -= h
+            fd = (_FEM(edges(vp), 10, 20, False, 'direct', density='coverage')[0] -
+                  _FEM(edges(vm), 10, 20, False, 'direct', density='coverage')[0]) / (2 * h)
+            analytic = (g[i, 1 + k] if i < len(EDGES) else 0) + (g[i - 1, 3 + k] if i > 0 else 0)
+            self.assertAlmostEqual(analytic / fd, 1.0, places=4)
+
+    def test_FEM_gradient(self):
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'cg', _SolverState(), True, gradient=True)
+        self.assertEqual(info['gsigma_x'].shape, (10, 20))
+        self.assertEqual(info['gsigma_edges'].shape, EDGES.shape)
+        self.assertTrue(np.all(info['gsigma_edges'][:, 0] == 0))
+        sigma, area, info_banded = _FEM(EDGES, 10, 20, False, 'banded', full_output=True,
+                                        gradient=True)
+        sigma, area, info_direct = _FEM(EDGES, 10, 20, False, 'direct', full_output=True,
+                                        gradient=True)
+        np.testing.assert_allclose(info_banded['gsigma_edges'], info_direct['gsigma_edges'],
+                                   rtol=1e-6, atol=1e-6 * np.abs(info_direct['gsigma_edges']).max())
+
+
+class SolverTest(unittest.TestCase):
+    def test_solvers_agree(self):
+        """Every solver backend converges and gives the same work of the load F.U, also
+        on the NOISY_EDGES with weakly attached material, and the same compliance on
+        EDGES. The compliance of designs with solid islands is not compared: it hangs
+        on the void stiffness (see _FEM) and differs by up to 7x between backends on
+        NOISY_EDGES, between 'direct' and 'banded' too."""
+        mesh = _get_mesh(10, 20)
+        solvers = ['cg', 'pcg', 'sgscg', 'banded', 'mgcg', 'mfcg', 'mixed', 'woodbury']
+        for k, edges in enumerate([EDGES] + NOISY_EDGES):
+            sigma, area, info = _FEM(edges, 10, 20, False, 'direct', full_output=True)
+            work = mesh.F[:, 0] @ info['U']
+            for solver in solvers:
+                sigma_solver, area_solver, info_solver = _FEM(edges, 10, 20, False, solver,
+                                                              full_output=True)
+                self.assertTrue(info_solver['converged'])
+                self.assertEqual(area, area_solver)
+                self.assertAlmostEqual(mesh.F[:, 0] @ info_solver['U'] / work, 1.0, places=5)
+                if k == 0:
+                    self.assertAlmostEqual(sigma_solver / sigma, 1.0, places=3)
+
+    def test_sgs_preconditioner(self):
+        """The symmetric Gauss-Seidel preconditioner is symmetric, so CG with it converges
+        and raises the work bound monotonically even on the ill-conditioned NOISY_EDGES,
+        where CG with an incomplete LU preconditioner ran off."""
+        mesh = _get_mesh(10, 20)
+        F2 = mesh.F[mesh.freedofs, 0]
+        for edges in NOISY_EDGES:
+            K2 = mesh.assemble_free(_rasterize(edges, 10, 20)[0])
+            M = _FEM_module._sgs(K2)
+            P = M @ np.eye(K2.shape[0])
+            np.testing.assert_allclose(P, P.T, rtol=0, atol=1e-12 * np.abs(P).max())
+            bounds = []
+            U2, info = cg(K2, F2, rtol=1e-5, maxiter=2000, M=M,
+                          callback=lambda u: bounds.append(_work_bound(K2, F2, u)))
+            self.assertEqual(info, 0)
+            self.assertTrue(np.all(np.diff(bounds) >= -1e-9 * bounds[-1]))
+            self.assertAlmostEqual(F2 @ U2 / (F2 @ _solve_direct(K2, F2)), 1.0, places=5)
+
+    def test_cg_not_converged(self):
+        """A CG solve that stops at its iteration limit gives no compliance, is flagged
+        and is neither cached nor kept as the next warm start."""
+        edges = NOISY_EDGES[3].copy()
+        edges[:, 1:] *= 4
+        state, cache = _SolverState(), _FEMCache(4)
+        sigma, area, info = _FEM(edges, 40, 80, False, 'pcg', state, full_output=True,
+                                 cache=cache)
+        self.assertEqual(sigma, np.inf)
+        self.assertFalse(info['converged'])
+        self.assertFalse(info['infeasible'])
+        self.assertEqual(state.iterations, 2000)
+        self.assertIsNone(state.U2)
+        self.assertEqual(len(cache.entries), 0)
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'pcg', full_output=True)
+        self.assertTrue(info['converged'])
+
+    def test_multigrid(self):
+        """Multigrid CG solves a finer mesh in far fewer iterations than Jacobi CG."""
+        edges = EDGES.copy()
+        edges[:, 1:] *= 4
+        sigma, area = _FEM(edges, 40, 80, False, solver='direct')
+        iterations = {}
+        for solver in ['mgcg', 'pcg']:
+            state = _SolverState()
+            sigma_solver, area_solver = _FEM(edges, 40, 80, False, solver, state)
+            iterations[solver] = state.iterations
+            self.assertAlmostEqual(sigma_solver / sigma, 1.0, places=3)
+        self.assertLess(iterations['mgcg'], 50)
+        self.assertLess(5 * iterations['mgcg'], iterations['pcg'])
+
+    def test_incremental_assembly(self):
+        """The state patches its stiffness matrix instead of assembling it again."""
+        state = _SolverState()
+        edges = EDGES.copy()
+        _FEM(edges, 10, 20, False, 'direct', state)
+        self.assertEqual(state.changed_elements, -1)
+        edges[2:5, 1:] += 0.3
+        sigma, area = _FEM(edges, 10, 20, False, 'direct', state)
+        self.assertGreater(state.changed_elements, 0)
+        self.assertLess(state.changed_elements, 10 * 20 // 4)
+        sigma_full, area_full = _FEM(edges, 10, 20, False, 'direct')
+        self.assertEqual(area, area_full)
+        self.assertAlmostEqual(sigma / sigma_full, 1.0, places=10)
+
+    def test_woodbury(self):
+        """Small moves around one design are solved by low rank corrections of its
+        factorization, larger ones refactorize."""
+        rng = np.random.RandomState(3)
+        base = EDGES.copy()
+        base[:, 1:] *= 2
+        state = _SolverState()
+        _FEM(base, 20, 40, False, 'woodbury', state)
+        reference = state.reference
+        for ii in range(3):
+            edges = base.copy()
+            edges[4, 1:] += 0.05 * rng.randn(4)
+            sigma, area = _FEM(edges, 20, 40, False, 'woodbury', state)
+            self.assertIs(state.reference, reference)
+            self.assertGreater(reference.rank, 0)
+            sigma_direct, area_direct = _FEM(edges, 20, 40, False, 'direct')
+            self.assertEqual(area, area_direct)
+            self.assertAlmostEqual(sigma / sigma_direct, 1.0, places=8)
+        edges[:, 1:] += 0.5
+        _FEM(edges, 20, 40, False, 'woodbury', state)
+        self.assertIsNot(state.reference, reference)
+        self.assertEqual(state.reference.rank, 0)
+
+    def test_mixed_precision(self):
+        """The float32 factorization refined in float64 gives the float64 compliance of
+        every load case to 1e-8, within a few refinement steps."""
+        rng = np.random.RandomState(0)
+        loads = ['uniform', 'point', 'lane', 'self_weight']
+        for k in range(4):
+            edges = EDGES.copy()
+            edges[:, 1:] += 0.05 * k * rng.randn(len(EDGES), 4)
+            sigma, area = _FEM(edges, 10, 20, False, 'banded', loads=loads)
+            state = _SolverState()
+            sigma_mixed, area = _FEM(edges, 10, 20, False, 'mixed', state, loads=loads)
+            np.testing.assert_allclose(sigma_mixed, sigma, rtol=1e-8)
+            self.assertLessEqual(state.iterations, 5)
+
+    def test_ordering(self):
+        """The reorderings are permutations of the free dofs, reorder gathers the
+        permuted matrix, and solving in either order gives the same compliance (and
+        gradient, for the exact solvers), also from a patched stiffness matrix."""
+        mesh = _get_mesh(10, 20)
+        K2 = mesh.assemble_free(_rasterize(EDGES, 10, 20)[0])
+        for kind in ['rcm', 'nd']:
+            perm, K2p = mesh.reorder(K2, kind)
+            np.testing.assert_array_equal(np.sort(perm), np.arange(len(mesh.freedofs)))
+            self.assertEqual(abs(K2p - K2[perm, :][:, perm]).max(), 0)
+            self.assertIs(mesh.ordering(kind)[0], perm)
+        loads = ['uniform', 'point']
+        moved = EDGES.copy()
+        moved[:, 1:] *= 0.98
+        for solver, kind in [('direct', 'rcm'), ('direct', 'nd'), ('banded', 'rcm'),
+                             ('mixed', 'rcm'), ('pcg', 'nd'), ('mgcg', 'nd')]:
+            state = _SolverState()
+            for edges in [EDGES, moved]:
+                sigma_ordered, area, info_ordered = _FEM(
+                        edges, 10, 20, False, solver, state, full_output=True,
+                        loads=loads, gradient=True, ordering=kind)
+            sigma, area, info = _FEM(moved, 10, 20, False, solver, full_output=True,
+                                     loads=loads, gradient=True)
+            if solver in ('pcg', 'mgcg'):
+                # the CG adjoint solves are too loose to compare gradients
+                np.testing.assert_allclose(sigma_ordered, sigma, rtol=1e-4)
+                continue
+            np.testing.assert_allclose(sigma_ordered, sigma, rtol=1e-8)
+            np.testing.assert_allclose(info_ordered['gsigma_x'], info['gsigma_x'],
+                                       rtol=1e-8, atol=1e-8 * abs(info['gsigma_x']).max())
+        with self.assertRaises(ValueError):
+            _FEM(EDGES, 10, 20, False, 'banded', ordering='nd')
+
+    def test_nested_dissection_fill(self):
+        """Factorized in nested dissection order, the stiffness matrix of a large mesh
+        fills in less than with SuperLU's own column ordering."""
+        mesh = _get_mesh(80, 160)
+        K2 = mesh.assemble_free(np.ones((80, 160))).tocsc()
+        perm, K2p = mesh.reorder(K2.tocsr(), 'nd')
+        lu = splu(K2, permc_spec='COLAMD')
+        lu_nd = splu(K2p.tocsc(), permc_spec='NATURAL', options=dict(SymmetricMode=True))
+        self.assertLess(lu_nd.L.nnz + lu_nd.U.nnz, 0.8 * (lu.L.nnz + lu.U.nnz))
+        F2 = mesh.F[mesh.freedofs, 0]
+        U2 = np.zeros(F2.shape)
+        U2[perm] = lu_nd.solve(F2[perm])
+        np.testing.assert_allclose(U2, lu.solve(F2), rtol=1e-8, atol=1e-8 * abs(U2).max())
+
+    def test_cold_start_by_default(self):
+        """Without warm_start the compliance of a design does not depend on the designs
+        solved before it with the same state."""
+        for solver in ['cg', 'pcg']:
+            for target in NOISY_EDGES[3:]:
+                sigma, area = _FEM(target, 10, 20, False, solver)
+                for previous in NOISY_EDGES[:3]:
+                    state = _SolverState()
+                    _FEM(previous, 10, 20, False, solver, state)
+                    sigma_state, area = _FEM(target, 10, 20, False, solver, state)
+                    self.assertEqual(sigma_state, sigma)
+
+    def test_warm_start(self):
+        """Re-solving the same design from the kept solution takes (almost) no iterations."""
+        for solver in ['cg', 'pcg']:
+            state = _SolverState(warm_start=True)
+            sigma, area = _FEM(EDGES, 10, 20, False, solver, state)
+            cold_iterations = state.iterations
+            M = state.M
+            sigma_warm, area = _FEM(EDGES, 10, 20, False, solver, state)
+            self.assertGreater(cold_iterations, 0)
+            self.assertLess(state.iterations, cold_iterations)
+            self.assertIs(state.M, M)
+            self.assertAlmostEqual(sigma_warm / sigma, 1.0, places=4)
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.edges = np.stack([EDGES] + [np.concatenate(
+            (EDGES[:, :1], EDGES[:, 1:] + 0.005 * rng.randn(len(EDGES), 4)), axis=1)
+            for _ in range(5)])
+
+    def test_rasterize_stack(self):
+        x, inside = _rasterize(self.edges, 10, 20)
+        self.assertEqual(x.shape, (6, 10, 20))
+        for k in range(len(self.edges)):
+            x_k, inside_k = _rasterize(self.edges[k], 10, 20)
+            np.testing.assert_array_equal(x[k], x_k)
+            np.testing.assert_array_equal(inside[k], inside_k)
+
+    def test_batch_matches_FEM(self):
+        for solver in ['cg', 'pcg', 'banded', 'direct', 'mgcg', 'mixed']:
+            compliance, area = _FEM_batch(self.edges, 10, 20, solver=solver)
+            for k in range(len(self.edges)):
+                sigma_k, area_k = _FEM(self.edges[k], 10, 20, False, solver=solver)
+                self.assertEqual(area[k], area_k)
+                if solver in ('banded', 'mixed'):
+                    self.assertAlmostEqual(compliance[k] / sigma_k, 1.0, places=6)
+                else:
+                    self.assertEqual(compliance[k], sigma_k)
+
+    def test_batch_not_converged(self):
+        """Only the designs whose CG solve does not converge get an infinite compliance."""
+        edges = np.stack([EDGES, NOISY_EDGES[3]])
+        edges[:, :, 1:] *= 4
+        compliance, area = _FEM_batch(edges, 40, 80, solver='pcg')
+        self.assertEqual(compliance[0], _FEM(edges[0], 40, 80, False, 'pcg')[0])
+        self.assertEqual(compliance[1], np.inf)
+
+    def test_banded_fallback(self):
+        """Blocks that are not numerically positive definite (solid islands held by
+        void material) are solved by the banded LU."""
+        rng = np.random.RandomState(0)
+        edges = np.stack([np.concatenate(
+            (EDGES[:, :1], EDGES[:, 1:] + 0.05 * rng.randn(len(EDGES), 4)), axis=1)
+            for _ in range(8)])
+        mesh = _get_mesh(10, 20)
+        K2 = mesh.assemble_free(_rasterize(edges, 10, 20)[0])
+        F2 = np.tile(mesh.F[mesh.freedofs, 0], len(edges))
+        with mock.patch.object(_FEM_module, 'solve_banded',
+                               wraps=_FEM_module.solve_banded) as lu:
+            U2 = _FEM_module._solve_banded(K2, F2, blocks=len(edges))
+        self.assertEqual(lu.call_count, 1)
+        self.assertLess(np.linalg.norm(K2 @ U2 - F2) / np.linalg.norm(F2), 1e-10)
+
+    def test_batch_repeated_designs(self):
+        """Repeated designs are solved once and get the compliance of their copies."""
+        edges = self.edges[[0, 2, 0, 5, 2, 2]]
+        compliance, area = _FEM_batch(edges, 10, 20)
+        compliance_distinct, area_distinct = _FEM_batch(self.edges, 10, 20)
+        np.testing.assert_array_equal(compliance, compliance_distinct[[0, 2, 0, 5, 2, 2]])
+        np.testing.assert_array_equal(area, area_distinct[[0, 2, 0, 5, 2, 2]])
+
+    def test_batch_density_fields(self):
+        x, inside = _rasterize(self.edges, 10, 20)
+        compliance, area = _FEM_batch(None, 10, 20, x=x)
+        compliance_edges, area_edges = _FEM_batch(self.edges, 10, 20)
+        np.testing.assert_allclose(compliance, compliance_edges)
+
+
+class CacheTest(unittest.TestCase):
+    def test_hit_returns_stored_solution(self):
+        """A design rasterizing to a cached density field is not solved again."""
+        cache = _FEMCache()
+        state = _SolverState()
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'cg', state, True, ['uniform', 'point'],
+                                 cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # a move away and back again, e.g. an agent undoing its last action
+        moved = EDGES.copy()
+        moved[3:5, 3] += 0.3
+        _FEM(moved, 10, 20, False, 'cg', state, loads=['uniform', 'point'], cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        edges = EDGES.copy()
+        sigma_hit, area_hit, info_hit = _FEM(edges, 10, 20, False, 'cg', state, True,
+                                             ['uniform', 'point'], gradient=True, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(state.iterations, 0)
+        np.testing.assert_array_equal(sigma_hit, sigma)
+        self.assertEqual(area_hit, area)
+        self.assertIs(info_hit['U'], info['U'])
+        np.testing.assert_array_equal(info_hit['von_mises'], info['von_mises'])
+        # the gradient asked for on the hit is kept for the next one
+        sigma_hit, area_hit, info_grad = _FEM(EDGES, 10, 20, False, 'cg', state, True,
+                                              ['uniform', 'point'], gradient=True, cache=cache)
+        self.assertIs(info_grad['gsigma_x'], info_hit['gsigma_x'])
+        # other load cases are another entry
+        _FEM(EDGES, 10, 20, False, 'cg', state, loads=['uniform'], cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def test_lru_eviction(self):
+        cache = _FEMCache(maxsize=2)
+        rng = np.random.RandomState(0)
+        x = [rng.rand(10, 20) for _ in range(3)]
+        for k in range(2):
+            cache.put(cache.key(x[k]), {'compliance': k})
+        self.assertIsNotNone(cache.get(cache.key(x[0])))
+        cache.put(cache.key(x[2]), {'compliance': 2})
+        self.assertIsNone(cache.get(cache.key(x[1])))
+        self.assertEqual(cache.get(cache.key(x[0]))['compliance'], 0)
+        self.assertEqual(cache.get(cache.key(x[2]))['compliance'], 2)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        cache.clear()
+        self.assertEqual((len(cache.entries), cache.hits, cache.misses), (0, 0, 0))
+
+
+class ComplianceLimitTest(unittest.TestCase):
+    def setUp(self):
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'direct', full_output=True)
+        self.work = info['U'] @ _get_mesh(10, 20).F[:, 0]
+        self.sigma = sigma
+
+    def test_work_bound_is_monotone(self):
+        mesh = _get_mesh(10, 20)
+        K2 = mesh.assemble_free(_rasterize(EDGES, 10, 20)[0])
+        f = mesh.F[mesh.freedofs, 0]
+        bounds = []
+        cg(K2, f, rtol=1e-05, maxiter=2000, callback=lambda u: bounds.append(_work_bound(K2, f, u)))
+        self.assertTrue(np.all(np.diff(bounds) >= -1e-8 * self.work))
+        self.assertLessEqual(bounds[-1], self.work * (1 + 1e-8))
+        self.assertAlmostEqual(bounds[-1] / self.work, 1.0, places=6)
+
+    def test_early_stop(self):
+        """Designs beyond the limit are rejected before the solve converges, the others
+        are solved as without a limit."""
+        for solver in ['cg', 'pcg', 'mgcg', 'direct']:
+            state = _SolverState()
+            sigma, area = _FEM(EDGES, 10, 20, False, solver, state)
+            iterations = state.iterations
+            state = _SolverState()
+            sigma_limit, area_limit, info = _FEM(EDGES, 10, 20, False, solver, state, True,
+                                                 compliance_limit=0.9 * self.work)
+            self.assertTrue(info['infeasible'])
+            self.assertEqual(sigma_limit, np.inf)
+            self.assertEqual(area_limit, area)
+            if solver in ['cg', 'pcg']:
+                self.assertLess(state.iterations, iterations)
+            sigma_limit, area_limit, info = _FEM(EDGES, 10, 20, False, solver,
+                                                 full_output=True, compliance_limit=1.1 * self.work)
+            self.assertFalse(info['infeasible'])
+            self.assertEqual(sigma_limit, sigma)
+
+    def test_load_cases(self):
+        """The limit holds for every load case, a rejected design has no gradient."""
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'pcg', None, True, ['point', 'uniform'],
+                                 gradient=True, compliance_limit=0.9 * self.work)
+        self.assertTrue(info['infeasible'])
+        np.testing.assert_array_equal(sigma, [np.inf, np.inf])
+        np.testing.assert_array_equal(info['gsigma_edges'], np.zeros((2,) + EDGES.shape))
+
+
+class RescaleTest(unittest.TestCase):
+    def solve(self, density, modulus=E0):
+        with mock.patch.object(_FEM_module, 'E0', modulus):
+            return _FEM(EDGES, 10, 20, False, 'direct', full_output=True,
+                        loads=['uniform', 'point'], density=density)
+
+    def rescale(self, density, load_scales, moduli):
+        sigma, area, info = self.solve(density)
+        return _rescale(_get_mesh(10, 20), info['x'], info['U'], sigma, info['von_mises'],
+                        load_scales, moduli)
+
+    def test_rescale_matches_solves(self):
+        """Rescaled to other moduli, compliance and stresses match solving again, and
+        scale with the square and the first power of the load."""
+        moduli = [5e10, E0, 4e11]
+        for density in ['sample', 'coverage']:
+            sigma, vm_max, vm_pnorm, error = self.rescale(density, [1.0, 3.0], moduli)
+            np.testing.assert_allclose(sigma[1], 9 * sigma[0], rtol=1e-14)
+            np.testing.assert_allclose(vm_max[1], 3 * vm_max[0], rtol=1e-14)
+            np.testing.assert_array_equal(error[1], 0)
+            self.assertTrue(np.all(error < 1e-14))
+            for j, modulus in enumerate(moduli):
+                sigma_E, area, info = self.solve(density, modulus)
+                np.testing.assert_allclose(sigma[0, j], sigma_E, rtol=1e-9)
+                np.testing.assert_allclose(vm_max[0, j], info['von_mises_max'], rtol=1e-9)
+                np.testing.assert_allclose(vm_pnorm[0, j], info['von_mises_pnorm'], rtol=1e-9)
+
+    def test_rescale_error(self):
+        """With a void modulus large enough to matter, the reported error estimates the
+        deviation of the rescaled stresses, and half that of the compliance."""
+        moduli = [5e10, 4e11]
+        with mock.patch.object(_FEM_module, 'Emin', 1e5):
+            sigma, vm_max, vm_pnorm, error = self.rescale('sample', [1.0], moduli)
+            for j, modulus in enumerate(moduli):
+                sigma_E, area, info = self.solve('sample', modulus)
+                deviation = abs(vm_max[0, j] / info['von_mises_max'] - 1)
+                self.assertTrue(np.all(deviation > 0.5 * error[j]))
+                self.assertTrue(np.all(deviation < 2 * error[j]))
+                deviation = abs(sigma[0, j] / sigma_E - 1)
+                self.assertTrue(np.all(deviation > error[j]))
+                self.assertTrue(np.all(deviation < 4 * error[j]))
+
+
+TestCases = [RasterizeTest, MeshTest, PostProcessTest, LoadCaseTest, GradientTest, SolverTest,
+             BatchTest, CacheTest, ComplianceLimitTest, RescaleTest]
+
+
+def run_tests(TestCaseList):
+    for testcase in TestCaseList:
+        Suite = unittest.TestLoader().loadTestsFromTestCase(testcase)
+        unittest.TextTestRunner(verbosity=2).run(Suite)
+
+
+if (__name__ == "__main__"):
+    run_tests(TestCases)
@@ -150,6 +150,17 @@ class UtilsTests(unittest.TestCase):
         bridge_env.seed(123456789)
         ob = bridge_env.reset()
 
+    def test_BHDEnv_packing_budget(self):
+        """A step whose packing is not solved within the budget ends the episode."""
+        bridge = BridgeHoleDesign(packing_solver='fixed_step', packing_max_iterations=1)
+        bridge_env = BHDEnv(
+            bridge=bridge, length=20, height=10, allowable_stress=200.0)
+        rld = bridge_env.rld.copy()
+        ob, reward, done, info = bridge_env.step(np.ones(len(rld)))
+        self.assertTrue(done)
+        self.assertEqual(reward, 0)
+        np.testing.assert_array_equal(bridge_env.rld, rld)
+
     def test_BHDEnv_trial(self):
         # TODO: Break into smaller tests.
         bridge_env = BHDEnv(
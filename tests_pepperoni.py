@@ -0,0 +1,315 @@
+"""tests_pepperoni.py"""
+
+import unittest
+import numpy as np
+from scipy.optimize import fsolve
+from pepperoni import BridgeHoleDesign, _theta_arround, _modify_boundary_edges, \
+    _get_grad_radii, _get_grad_edges, _angle_sums, _angle_jacobian, _calculate_radii, \
+    _modify_circlepacking
+from _FEM import _FEM, E0
+
+
+class GradientTest(unittest.TestCase):
+    """ Check the derivatives with respect to the radii of the leading dancers against
+    finite differences of a packing solved to machine precision.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bridge = BridgeHoleDesign(solver='direct', sigma_gradient=True)
+        packing = cls.bridge._packing
+        cls.targets = packing.total_angle[packing.ad]
+        cls.rld = np.array(cls.bridge.rld)
+
+    def pack(self, rld):
+        """Solve the radii of the accompanying dancers for rld, lay out, return the edges."""
+        packing = self.bridge._packing
+        packing.radius[packing.ld] = rld
+        ad = range(packing.n_ld, len(packing.radius))
+        def theta_diff(radii):
+            packing.radius[packing.ad] = radii
+            r = packing.radius.tolist()
+            return np.array([_theta_arround(r, i, packing.fan(i).tolist())
+                             for i in ad]) - self.targets
+        theta_diff(fsolve(theta_diff, packing.radius[packing.ad], xtol=1e-13))
+        edges = np.ones((packing.n_ld - 1, 5))
+        _modify_boundary_edges(edges, packing)
+        return edges
+
+    def finite_difference(self, f, j, h=1e-6):
+        rp = self.rld.copy()
+        rp[j] += h
+        rm = self.rld.copy()
+        rm[j] -= h
+        return (f(rp) - f(rm)) / (2 * h)
+
+    def test_grad_radii_and_edges(self):
+        b = self.bridge
+        self.pack(self.rld)
+        dr = _get_grad_radii(b._packing)
+        gedges = _get_grad_edges(b._packing)
+        radii = lambda rld: (self.pack(rld), b._packing.radius.copy())[1]
+        for j in [0, 4, 9]:
+            np.testing.assert_allclose(self.finite_difference(radii, j), dr[:, j],
+                                       rtol=1e-5, atol=1e-7)
+            np.testing.assert_allclose(self.finite_difference(self.pack, j), gedges[:, :, j],
+                                       rtol=1e-5, atol=1e-7)
+
+    def test_gsigma_rld(self):
+        b = self.bridge
+        b._edges = self.pack(self.rld)
+        b._analyse()
+        sigma = lambda rld: _FEM(self.pack(rld), b.nely, b.nelx, False, 'direct')[0]
+        for j in range(len(self.rld)):
+            self.assertAlmostEqual(self.finite_difference(sigma, j, 1e-5) / b.gsigma_rld[j],
+                                   1.0, places=4)
+
+    def test_update_data(self):
+        bridge = BridgeHoleDesign(sigma_gradient=True)
+        data = bridge.update(bridge.rld)
+        self.assertEqual(len(data['gsigma_rld']), len(bridge.rld))
+        self.assertEqual(data['sigma'], bridge.sigma)
+        self.assertFalse(data['infeasible'])
+
+    def test_sigma_gradient_off(self):
+        """By default an update skips the adjoint solve and reports no gradient."""
+        bridge = BridgeHoleDesign()
+        data = bridge.update(bridge.rld)
+        self.assertIsNone(data['gsigma_rld'])
+        self.assertNotIn('gsigma_edges', bridge._fem_info)
+        self.assertAlmostEqual(data['sigma'], BridgeHoleDesign(sigma_gradient=True).update(bridge.rld)['sigma'])
+
+    def test_adaptive_mesh(self):
+        """A bridge on the adaptive mesh updates and sweeps with the fields of its grid."""
+        bridge = BridgeHoleDesign(solver='banded', mesh_type='adaptive')
+        data = bridge.update(bridge.rld)
+        self.assertFalse(data['infeasible'])
+        self.assertEqual(bridge._fem_info['von_mises'].shape[-2:], (bridge.nely, bridge.nelx))
+        self.assertAlmostEqual(bridge.sweep()['sigma'][0, 0], data['sigma'])
+        with self.assertRaises(ValueError):
+            BridgeHoleDesign(mesh_type='adaptive', sigma_gradient=True)
+
+    def test_compliance_limit(self):
+        """A bridge beyond its compliance limit gets the stress of invalid designs."""
+        bridge = BridgeHoleDesign(compliance_limit=1.0, sigma_gradient=True)
+        data = bridge.update(bridge.rld)
+        self.assertTrue(data['infeasible'])
+        self.assertEqual(data['sigma'], 2**16 - 1)
+        self.assertEqual(data['gsigma_rld'], [0.0] * len(bridge.rld))
+
+    def test_fem_cache(self):
+        """Repeating an update finds its density field in the bridge's FEM cache."""
+        bridge = BridgeHoleDesign(sigma_gradient=True)
+        data = bridge.update(bridge.rld)
+        hits, misses = bridge.fem_cache.hits, bridge.fem_cache.misses
+        data_hit = bridge.update(bridge.rld)
+        self.assertEqual((bridge.fem_cache.hits, bridge.fem_cache.misses), (hits + 1, misses))
+        self.assertEqual(data_hit['sigma'], data['sigma'])
+        self.assertEqual(data_hit['gsigma_rld'], data['gsigma_rld'])
+        self.assertIsNone(BridgeHoleDesign(fem_cache_size=0).fem_cache)
+
+    def test_update_history(self):
+        """An update gives a design the same sigma whatever the bridge solved before."""
+        target = np.array(BridgeHoleDesign().rld)
+        sigma = []
+        for previous in [target, target + 0.005, target - 0.005]:
+            bridge = BridgeHoleDesign(fem_cache_size=0)
+            bridge.update(previous)
+            sigma.append(bridge.update(target)['sigma'])
+        np.testing.assert_allclose(sigma, sigma[0], rtol=1e-7)
+
+    def test_sweep(self):
+        """The sweep reproduces the bridge's own results at its parameters, scales them
+        with the load and checks them against every allowable stress."""
+        bridge = BridgeHoleDesign(load_cases=['uniform', 'point'])
+        data = bridge.update(bridge.rld)
+        grid = bridge.sweep(load_scales=[1.0, 2.0], moduli=[E0, 2*E0],
+                            allowable_stresses=[0.5*data['sigma'], 2*data['sigma']])
+        self.assertEqual(grid['sigma'].shape, (2, 2))
+        self.assertEqual(grid['sigma_cases'].shape, (2, 2, 2))
+        self.assertAlmostEqual(grid['sigma'][0, 0], data['sigma'])
+        self.assertAlmostEqual(grid['von_mises_max'][0, 0], data['von_mises_max'])
+        self.assertAlmostEqual(grid['sigma'][1, 1], data['sigma'])
+        np.testing.assert_array_equal(grid['feasible'][0, 0], [False, True])
+        np.testing.assert_allclose(grid['stress_ratio'][0, 0], [-1.0, 0.5])
+        self.assertEqual(grid['sigma_error'][0], 0)
+        self.assertLess(grid['sigma_error'][1], 1e-12)
+
+        infeasible = BridgeHoleDesign(compliance_limit=1.0).sweep(load_scales=[0.5, 1.0])
+        np.testing.assert_array_equal(infeasible['sigma'], 2**16 - 1)
+        self.assertFalse(np.any(infeasible['feasible']))
+
+
+
+class PackingTest(unittest.TestCase):
+    """The array model of the circle packing."""
+
+    def test_views_follow_updates(self):
+        bridge = BridgeHoleDesign()
+        packing = bridge._packing
+        for view in [bridge.rld, bridge.raccb, bridge.ri, bridge.positions_ld]:
+            self.assertTrue(np.shares_memory(view, packing.radius) or
+                            np.shares_memory(view, packing.xy))
+        rld = bridge.rld + 0.001
+        data = bridge.update(rld)
+        np.testing.assert_array_equal(bridge.rld, rld)
+        np.testing.assert_array_equal(bridge.r[:packing.n_ld], rld)
+        np.testing.assert_array_equal(bridge._edges[:, 1:3], bridge.positions_ld[:-1])
+        self.assertIs(data['ri'], bridge.ri)
+
+    def test_topology(self):
+        packing = BridgeHoleDesign()._packing
+        n = len(packing.radius)
+        self.assertEqual(packing.n_ld + packing.n_accb + packing.n_ci, n)
+        np.testing.assert_array_equal(np.sort(packing.point), np.arange(n))
+        # the fans of interior circles are closed, the boundary ones are not
+        for i in range(n):
+            fan = packing.fan(i)
+            self.assertEqual(fan[0] == fan[-1], i >= packing.n_ld + packing.n_accb)
+        self.assertEqual(len(packing.corners), len(packing.fan_index) - n)
+        # every corner is the corner of a face, every face has its three corners
+        faces = {tuple(sorted(f)) for f in packing.faces.tolist()}
+        self.assertEqual({tuple(sorted(c)) for c in packing.corners.tolist()}, faces)
+        self.assertEqual(len(packing.corners), 3 * len(faces))
+        # the layout places every circle but the anchors once
+        placed = np.concatenate((packing.anchor_x, packing.anchor_y, packing.layout[:, 2]))
+        np.testing.assert_array_equal(np.sort(placed), np.arange(n))
+
+    def test_angle_sums(self):
+        """The one pass angle sums match the per circle sums, also for a subset of the
+        corners and for other radii."""
+        packing = BridgeHoleDesign()._packing
+        for radius in [packing.radius, packing.radius * (1 + 0.01 * np.sin(np.arange(
+                len(packing.radius))))]:
+            r = radius.tolist()
+            theta_loop = [_theta_arround(r, i, packing.fan(i).tolist()) for i in range(len(r))]
+            theta, residual = _angle_sums(packing, radius=radius)
+            np.testing.assert_allclose(theta, theta_loop, rtol=1e-14)
+            np.testing.assert_array_equal(residual, theta - packing.total_angle)
+        corners = np.flatnonzero(packing.corners[:, 0] >= packing.n_ld)
+        theta_ad, residual_ad = _angle_sums(packing, corners)
+        np.testing.assert_array_equal(theta_ad[:packing.n_ld], 0)
+        np.testing.assert_allclose(theta_ad[packing.ad], _angle_sums(packing)[0][packing.ad],
+                                   rtol=1e-15)
+        self.assertTrue(np.all(np.abs(residual_ad[packing.ad]) <= 0.1 * 0.01))
+
+    def test_angle_jacobian(self):
+        packing = BridgeHoleDesign()._packing
+        J = _angle_jacobian(packing).toarray()
+        h = 1e-7
+        for j in [0, packing.n_ld, len(packing.radius) - 1]:
+            radius = packing.radius.copy()
+            radius[j] += h
+            fd = (_angle_sums(packing, radius=radius)[0] - _angle_sums(packing)[0]) / h
+            np.testing.assert_allclose(J[:, j], fd, atol=1e-5)
+
+    def test_newton_radii(self):
+        """Newton converges in a few steps to the radii of the fixed steps, keeps the
+        leading dancers and the left out circle, and reports its residual."""
+        bridge = BridgeHoleDesign()
+        packing = bridge._packing
+        rld = bridge.rld + 0.01
+        r0 = packing.radius.copy()
+        radii = {}
+        for method in ['fixed_step', 'newton']:
+            packing.radius[:] = r0
+            iterations, residual, status = _modify_circlepacking(rld, packing, 1e-3, 1e-4,
+                                                                 method)
+            self.assertEqual(status, 'converged')
+            np.testing.assert_array_equal(packing.radius[packing.ld], rld)
+            self.assertLessEqual(residual, 1e-3)
+            self.assertEqual(residual, np.max(np.abs(_angle_sums(packing)[1][packing.ad])))
+            radii[method] = packing.radius.copy()
+            if method == 'newton':
+                self.assertLessEqual(iterations, 10)
+        np.testing.assert_allclose(radii['newton'], radii['fixed_step'], rtol=1e-2)
+        # all circles but the left out one
+        r1 = packing.radius[1]
+        iterations, residual, status = _calculate_radii(packing, slice(None), 1e-10, None,
+                                                        leavingout=1)
+        self.assertEqual(packing.radius[1], r1)
+        self.assertLessEqual(residual, 1e-10)
+        with self.assertRaises(ValueError):
+            _calculate_radii(packing, packing.ad, 1e-4, 1e-4, method='secant')
+
+    def test_update_reports_packing_solve(self):
+        """Every packing solver starts from the same initial design and converges on an
+        update."""
+        rld = BridgeHoleDesign(packing_solver='fixed_step').rld
+        for method in ['newton', 'fixed_step', 'local']:
+            bridge = BridgeHoleDesign(packing_solver=method)
+            np.testing.assert_array_equal(bridge.rld, rld)
+            data = bridge.update(bridge.rld + 0.005)
+            self.assertGreater(data['packing_iterations'], 0)
+            self.assertLessEqual(data['packing_residual'], 0.1 * bridge.eps)
+            self.assertEqual(data['packing_status']['status'], 'converged')
+            self.assertTrue(data['packing_status']['converged'])
+
+    def test_local_radii(self):
+        """After moving one leading dancer the local solve only relaxes circles near
+        it, and lands within eps of the Newton radii."""
+        bridge = BridgeHoleDesign()
+        packing = bridge._packing
+        _modify_circlepacking(bridge.rld, packing, 1e-3, None)
+        r0 = packing.radius.copy()
+        rld = bridge.rld.copy()
+        rld[3] += 0.005
+        radii = {}
+        for method in ['newton', 'local']:
+            packing.radius[:] = r0
+            iterations, residual, status = _modify_circlepacking(rld, packing, 1e-3, None,
+                                                                 method)
+            self.assertEqual(status, 'converged')
+            self.assertEqual(residual, np.max(np.abs(_angle_sums(packing)[1][packing.ad])))
+            radii[method] = packing.radius.copy()
+        self.assertLessEqual(residual, 1e-3)
+        self.assertLess(iterations, packing.n_accb + packing.n_ci)
+        # the circles far from the moved one are not touched
+        self.assertGreater(np.sum(radii['local'] == r0), len(r0) // 2)
+        np.testing.assert_allclose(radii['local'], radii['newton'], rtol=1e-2)
+        packing.radius[:] = r0
+        self.assertEqual(_modify_circlepacking(rld + 0.02, packing, 1e-3, None, 'local',
+                                               max_iterations=5)[2], 'max_iterations')
+
+    def test_packing_budgets(self):
+        """The radii solve stops at its budgets, on oscillation and on divergence, and
+        update() then reports it and stays at the previous design."""
+        bridge = BridgeHoleDesign()
+        packing = bridge._packing
+        rld = bridge.rld + 0.01
+        r0 = packing.radius.copy()
+        # steps too coarse for eps oscillate, steps of twice the radius blow up
+        for delta_r, patience, expected in [(1e-4, 100, 'stagnated'), (2.0, None, 'diverged')]:
+            packing.radius[:] = r0
+            with np.errstate(invalid='ignore'):
+                status = _modify_circlepacking(rld, packing, 1e-4, delta_r, 'fixed_step',
+                                               patience=patience)[2]
+            self.assertEqual(status, expected)
+        packing.radius[:] = r0
+        iterations, residual, status = _modify_circlepacking(rld, packing, 1e-3, 1e-4,
+                                                             'fixed_step', max_iterations=10)
+        self.assertEqual((iterations, status), (10, 'max_iterations'))
+        packing.radius[:] = r0
+        iterations, residual, status = _modify_circlepacking(rld, packing, 1e-3, 1e-4,
+                                                             time_budget=0)
+        self.assertEqual((iterations, status), (0, 'time_budget'))
+        bridge = BridgeHoleDesign(packing_solver='fixed_step', packing_max_iterations=5)
+        rld_old = bridge.rld.copy()
+        data = bridge.update(rld_old + 0.02)
+        self.assertEqual(data['packing_status']['status'], 'max_iterations')
+        self.assertFalse(data['packing_status']['converged'])
+        self.assertEqual(data['packing_status']['iterations'], 5)
+        np.testing.assert_array_equal(bridge.rld, rld_old)
+
+
+TestCases = [GradientTest, PackingTest]
+
+
+def run_tests(TestCaseList):
+    for testcase in TestCaseList:
+        Suite = unittest.TestLoader().loadTestsFromTestCase(testcase)
+        unittest.TextTestRunner(verbosity=2).run(Suite)
+
+
+if (__name__ == "__main__"):
+    run_tests(TestCases)
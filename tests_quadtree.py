@@ -0,0 +1,114 @@
+"""tests_quadtree.py"""
+
+import unittest
+import numpy as np
+from _FEM import _FEM, _rasterize, _get_mesh, _LOADS
+from _quadtree import _QuadTree, _FEM_adaptive
+from tests_FEM import EDGES
+
+
+class QuadTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = _QuadTree(EDGES, 10, 20, 3)
+
+    def test_balanced(self):
+        """Edge neighbours differ by at most one level, the grid is refined near the hole
+        only."""
+        level = self.tree.level
+        self.assertLessEqual(np.max(np.abs(np.diff(level, axis=0))), 1)
+        self.assertLessEqual(np.max(np.abs(np.diff(level, axis=1))), 1)
+        self.assertEqual(level.max(), 3)
+        self.assertEqual(level[-1, -1], 0)
+        self.assertEqual(np.sum(self.tree.size**2), level.size)
+
+    def test_hanging_nodes(self):
+        """Hanging nodes move with the mean of the ends of their edge, fixed dofs not at
+        all."""
+        tree = self.tree
+        self.assertGreater(len(tree.hanging), 0)
+        U = tree.T @ np.random.RandomState(0).randn(len(tree.freedofs))
+        h, a, b = tree.hanging.T
+        for d in range(2):
+            np.testing.assert_allclose(U[2*h+d], 0.5*(U[2*a+d] + U[2*b+d]))
+        np.testing.assert_array_equal(U[2*np.nonzero(tree.nodes[:, 1] == 80)[0]+1], 0)
+        np.testing.assert_array_equal(U[2*np.nonzero(tree.nodes[:, 0] == 0)[0]], 0)
+
+    def test_loads(self):
+        """The deck loads are those of _FEM, the self weight is independent of the
+        refinement."""
+        mesh = _get_mesh(10, 20)
+        x, inside = self.tree.rasterize(EDGES)
+        x_grid, inside = _rasterize(EDGES, 10, 20)
+        for load in ['uniform', 'point', 'lane']:
+            self.assertAlmostEqual(np.sum(self.tree.load(load, x)),
+                                   np.sum(_LOADS[load](mesh, x_grid)))
+        self.assertAlmostEqual(np.sum(self.tree.load('self_weight', np.ones(len(x)))), -10**7)
+
+
+class AdaptiveFEMTest(unittest.TestCase):
+    def test_no_refinement_is_FEM(self):
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'banded', full_output=True,
+                                 loads=['uniform', 'self_weight'])
+        sigma_tree, area_tree, info_tree = _FEM_adaptive(EDGES, 10, 20, 0, full_output=True,
+                                                         loads=['uniform', 'self_weight'])
+        np.testing.assert_allclose(sigma_tree, sigma, rtol=1e-10)
+        self.assertEqual(area_tree, area)
+        np.testing.assert_array_equal(info_tree['x'], info['x'].T.ravel())
+        np.testing.assert_allclose(info_tree['von_mises_max'], info['von_mises_max'],
+                                   rtol=1e-10)
+
+    def test_refined_near_hole(self):
+        """Refining near the hole only gets close to the uniformly refined tree with far
+        fewer dofs."""
+        sigma, area, info = _FEM_adaptive(EDGES, 10, 20, 3, full_output=True)
+        sigma_uniform, area_uniform = _FEM_adaptive(EDGES, 10, 20, 3, pad=np.inf)
+        self.assertEqual(area, area_uniform)
+        self.assertAlmostEqual(sigma / sigma_uniform, 1.0, delta=0.05)
+        uniform = _QuadTree(EDGES, 10, 20, 3, pad=np.inf)
+        self.assertLess(len(info['tree'].freedofs), len(uniform.freedofs) / 4)
+        self.assertEqual(info['x'].shape, info['von_mises'].shape)
+
+    def test_grid_output(self):
+        """With mesh_type='adaptive' _FEM gives the fields of the tree on its own grid,
+        those of the uniform mesh when nothing is refined, and refuses the gradient."""
+        loads = ['uniform', 'self_weight']
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'banded', full_output=True,
+                                 loads=loads)
+        sigma_tree, area_tree, info_tree = _FEM_adaptive(EDGES, 10, 20, 0, full_output=True,
+                                                         loads=loads, grid=True)
+        for key in ['x', 'U', 'strain_energy', 'von_mises', 'von_mises_pnorm']:
+            self.assertEqual(np.shape(info_tree[key]), np.shape(info[key]))
+            np.testing.assert_allclose(info_tree[key], info[key], rtol=1e-10, atol=1e-20)
+
+        sigma, area, info = _FEM(EDGES, 10, 20, False, 'banded', full_output=True,
+                                 loads=loads, mesh_type='adaptive')
+        sigma_tree, area_tree, info_tree = _FEM_adaptive(EDGES, 10, 20, full_output=True,
+                                                         loads=loads)
+        np.testing.assert_array_equal(sigma, sigma_tree)
+        self.assertEqual(area, area_tree)
+        self.assertFalse(info['infeasible'])
+        self.assertEqual(info['x'].shape, (10, 20))
+        self.assertEqual(info['von_mises'].shape, (2, 10, 20))
+        size = info_tree['tree'].size
+        self.assertAlmostEqual(np.sum(info['x']), np.sum(info_tree['x'] * (size / 8)**2))
+        np.testing.assert_allclose(np.sum(info['strain_energy'], axis=(-2, -1)),
+                                   np.sum(info_tree['strain_energy'], axis=-1))
+        np.testing.assert_array_equal(info['von_mises_max'], info_tree['von_mises_max'])
+        np.testing.assert_array_equal(info['U'], info_tree['U'][:, info_tree['tree'].grid_dofs])
+        self.assertTrue(np.all(np.isinf(_FEM(EDGES, 10, 20, False, mesh_type='adaptive',
+                                             loads=loads, compliance_limit=1e-12)[0])))
+        with self.assertRaises(ValueError):
+            _FEM(EDGES, 10, 20, False, full_output=True, gradient=True, mesh_type='adaptive')
+
+
+TestCases = [QuadTreeTest, AdaptiveFEMTest]
+
+
+def run_tests(TestCaseList):
+    for testcase in TestCaseList:
+        Suite = unittest.TestLoader().loadTestsFromTestCase(testcase)
+        unittest.TextTestRunner(verbosity=2).run(Suite)
+
+
+if (__name__ == "__main__"):
+    run_tests(TestCases)